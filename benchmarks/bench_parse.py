@@ -0,0 +1,279 @@
+###############################################################################
+# Benchmarks of the population path, on synthetic data from 'synthetic.py'.
+#
+# Micro-benchmarks time every hot function on one generated company and print
+# calls per second. The end-to-end benchmark writes a dataset to a temporary
+# folder, parses it like 'initial_pop.py' and prints filings per second and
+# peak memory. The same seed gives the same data, so runs are comparable
+# between commits.
+#
+# Run from the repository root:
+# python -m benchmarks.bench_parse
+# python -m benchmarks.bench_parse --only end-to-end --companies 500 --lazy
+# python -m benchmarks.bench_parse --only end-to-end --workers 4
+# python -m benchmarks.bench_parse --only end-to-end --sqlite
+#
+# With --sqlite every company is also written to a fresh SQLite database, with
+# the upserts of the population, so loading is profiled without PostgreSQL.
+#
+###############################################################################
+
+import gc
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+from sqlalchemy.dialects import postgresql
+
+from nbb_data import functions
+from nbb_data.classes import (
+    References, Filing, LazyFiling, Person, Entity, PersonIndex, NBBConnector
+)
+from nbb_data.functions import normalise_strings, fuzzy_keys
+from nbb_data.bootstrap import bootstrap
+from nbb_data.identity import IdentityCache
+from nbb_data.population import (
+    parse_company, parse_companies, build_statements
+)
+from nbb_data.store import FileStore, open_store
+from benchmarks.synthetic import company, country_codes, write_dataset
+
+
+def best_time(fn, *, repeat=5, min_time=0.2) -> float:
+    """Return the best time per call of fn over repeat runs of at least
+    min_time seconds each."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+
+def micro(args):
+    refs, filings = company(
+        0, seed=args.seed, persons=args.persons, rubrics=args.rubrics)
+    raw = json.dumps(next(iter(filings.values()))).encode()
+    data = json.loads(raw)
+    countries = country_codes()
+
+    natural = data["Administrators"]["NaturalPersons"][0]["Person"]
+    legal = data["Administrators"]["LegalPersons"][0]["Entity"]
+    names = [
+        v for n in data["Administrators"]["NaturalPersons"]
+        for v in (n["Person"]["FirstName"], n["Person"]["LastName"],
+                  n["Person"]["Address"]["Street"])
+        ]
+
+    # A company rarely has more than a few dozen persons, a warmed identity
+    # block holds hundreds. Time a miss, which compares against every key.
+    index = PersonIndex()
+    for i in range(args.index_size):
+        person = Person(
+            company(i, seed=args.seed, years=1, persons=1, rubrics=1)[1]
+            .popitem()[1]["Administrators"]["NaturalPersons"][0]["Person"],
+            countries
+            )
+        index[person.key] = person
+    keys = list(index.keys())
+    miss = ("zacharias", "xylophonides", "nowherestraat", "999")
+
+    store = _MemoryStore()
+    store.put("ref", json.dumps(refs).encode())
+    for key, value in filings.items():
+        store.put(key, json.dumps(value).encode())
+    cleaned = parse_company("ref", store, store, countries)
+    statements = build_statements(cleaned)
+    dialect = postgresql.dialect()
+
+    def normalise_cold():
+        functions._normalise.cache_clear()
+        normalise_strings(names)
+
+    benches = [
+        ("References", lambda: References(refs)),
+        ("json.loads + Filing", lambda: Filing(json.loads(raw))),
+        ("LazyFiling, N rubrics", lambda: list(LazyFiling(raw).rubrics)),
+        ("Filing.iter_rubrics", lambda: list(Filing(data).iter_rubrics())),
+        ("Person", lambda: Person(natural, countries)),
+        ("Entity", lambda: Entity(legal, countries)),
+        ("normalise_strings, cold", normalise_cold),
+        ("normalise_strings, cached", lambda: normalise_strings(names)),
+        (f"fuzzy_keys, {len(keys)} keys", lambda: fuzzy_keys(miss, keys)),
+        (f"PersonIndex.match, {len(keys)} keys", lambda: index.match(miss)),
+        ("parse_company", lambda: parse_company(
+            "ref", store, store, countries)),
+        ("build_statements", lambda: build_statements(cleaned)),
+        ("compile statements", lambda: [
+            s.compile(dialect=dialect) for s in statements]),
+    ]
+
+    print(
+        f"One company: {len(filings)} filings, {args.persons} persons, "
+        f"{args.rubrics} rubrics per period")
+    for name, fn in benches:
+        if args.filter and args.filter not in name:
+            continue
+        per_call = best_time(fn, repeat=args.repeat)
+        print(
+            f"  {name:<32} {1 / per_call:>12,.1f} /s "
+            f"{per_call * 1e6:>12,.1f} us")
+
+
+class _MemoryStore(FileStore):
+    """FileStore kept in a dict, so micro-benchmarks do not time the disk."""
+    def __init__(self):
+        self.documents: dict[str, bytes] = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.documents
+
+    def keys(self):
+        return iter(self.documents)
+
+    def get(self, key) -> bytes | None:
+        return self.documents.get(key)
+
+    def put(self, key, data: bytes):
+        self.documents[key] = data
+
+
+def parse_all(folder, keys, args, engine=None) -> tuple[int, int]:
+    """
+    Parse every company, return (companies, filings) parsed. With engine,
+    write them too, each company in its own savepoint like 'initial_pop.py'.
+    """
+    companies = filings = 0
+    if engine is not None:
+        identities = IdentityCache()
+        conn = engine.connect()
+        transaction = conn.begin()
+    for cleaned in parse_companies(
+        keys,
+        f"{folder}/temp_references",
+        f"{folder}/temp_filing",
+        country_codes(),
+        packed=args.packed,
+        lazy=args.lazy,
+        workers=args.workers
+    ):
+        if engine is not None and cleaned.company_info:
+            identities.resolve(cleaned)
+            with conn.begin_nested():
+                for stmt in build_statements(cleaned, engine.dialect.name):
+                    conn.execute(stmt)
+        elif args.statements and cleaned.company_info:
+            for stmt in build_statements(cleaned):
+                stmt.compile(dialect=postgresql.dialect())
+        companies += 1
+        filings += len(cleaned.statements_list)
+    if engine is not None:
+        transaction.commit()
+        conn.close()
+    return companies, filings
+
+
+def sqlite_engine(folder, run: int):
+    """Return the engine of a new SQLite database with the nbb schema."""
+    engine = NBBConnector(
+        "bulk-load", sqlite=f"{folder}/bench_{run}.db").engine
+    bootstrap(engine)
+    return engine
+
+
+def end_to_end(args):
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        write_dataset(
+            folder,
+            args.companies,
+            packed=args.packed,
+            seed=args.seed,
+            persons=args.persons,
+            rubrics=args.rubrics
+            )
+        print(
+            f"Generated {args.companies} companies in "
+            f"{time.perf_counter() - start:.1f}s")
+
+        store = open_store(f"{folder}/temp_references", packed=args.packed)
+        keys = sorted(store.keys())
+        store.close()
+
+        mode = (
+            f"workers={args.workers} lazy={args.lazy} packed={args.packed} "
+            f"statements={args.statements} sqlite={args.sqlite}")
+        times = []
+        for run in range(args.repeat):
+            engine = sqlite_engine(folder, run) if args.sqlite else None
+            gc.collect()
+            start = time.perf_counter()
+            companies, filings = parse_all(folder, keys, args, engine)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print(f"End to end ({mode}):")
+        print(
+            f"  {filings} filings of {companies} companies, best of "
+            f"{args.repeat}: {best:.2f}s")
+        print(f"  {filings / best:,.1f} filings/s")
+
+        # Tracing slows parsing down, so memory is measured in its own run.
+        # Worker processes are not traced, their peak shows in max RSS.
+        if args.workers <= 1 and not args.sqlite:
+            gc.collect()
+            tracemalloc.start()
+            parse_all(folder, keys, args)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"  peak traced memory: {peak / 2**20:,.1f} MiB")
+
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(
+            f"  max RSS: {own / 1024:,.1f} MiB"
+            + (f", workers {children / 1024:,.1f} MiB"
+               if args.workers > 1 else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark parsing of synthetic NBB filings.")
+    parser.add_argument(
+        "--only", choices=["micro", "end-to-end"], default=None)
+    parser.add_argument(
+        "--filter", default="", help="only micro-benchmarks matching this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--persons", type=int, default=4)
+    parser.add_argument("--rubrics", type=int, default=400)
+    parser.add_argument("--index-size", type=int, default=500)
+    parser.add_argument("--companies", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--packed", action="store_true")
+    parser.add_argument(
+        "--statements", action="store_true",
+        help="also build and compile the upsert statements")
+    parser.add_argument(
+        "--sqlite", action="store_true",
+        help="also write every company to a new SQLite database")
+    args = parser.parse_args()
+
+    if args.only in (None, "micro"):
+        micro(args)
+    if args.only in (None, "end-to-end"):
+        end_to_end(args)
@@ -0,0 +1,352 @@
+###############################################################################
+# Local stand-in for the NBB CBSO API, to exercise the fetch scripts without
+# spending subscription quota.
+#
+# Serves the routes built by nbb_data.classes.URLgen_nbb:
+#   - authentic/legalEntity/{enterprise id}/references
+#   - authentic/deposit/{reference number}/accountingData
+#   - extracts/batch/{date}/references
+#   - extracts/batch/{date}/accountingData
+# from synthetic companies ('synthetic.py'), or replays the reference lists and
+# filings of stores written by 'initial_fetch.py' with --replay. The
+# AccountingDataURL of every reference points back at this server.
+#
+# Latency, 429 (with Retry-After) and 5xx responses are injected at random,
+# from a seeded generator, so a load test is reproducible. Counts per status
+# are printed on exit.
+#
+# Run from the repository root, then point the fetchers at it:
+# python -m benchmarks.mock_cbso --port 8080 --companies 1000 --csv server4.csv
+#     --latency 0.05 --jitter 0.02 --rate-429 0.05 --rate-5xx 0.01
+# NBB_BASE_URL=http://127.0.0.1:8080/ python -m nbb_data.initial_fetch
+#
+###############################################################################
+
+import re
+import json
+import gzip
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from nbb_data.store import open_store
+from benchmarks.synthetic import company, enterprise_number
+
+
+class SyntheticSource:
+    """
+    Companies 0 to companies - 1 of synthetic.company(), generated on first
+    request. params go to company(). The last 'cached' companies generated
+    are kept.
+    """
+    cached = 1024
+
+    def __init__(self, companies: int, **params):
+        self.companies = companies
+        self.params = params
+        self._batches: dict[str, list[dict]] | None = None
+        self._cache: dict[int, tuple] = {}
+        self._lock = threading.RLock()  # batch() generates while holding it
+
+    def _company(self, index: int):
+        with self._lock:
+            if index not in self._cache:
+                if len(self._cache) >= self.cached:
+                    del self._cache[next(iter(self._cache))]
+                self._cache[index] = company(index, **self.params)
+            return self._cache[index]
+
+    def _index(self, index: int) -> int | None:
+        return index if 0 <= index < self.companies else None
+
+    def enterprise_ids(self) -> list[str]:
+        return [enterprise_number(i) for i in range(self.companies)]
+
+    def references(self, enterprise_id: str) -> list[dict] | None:
+        index = self._index(int(enterprise_id) - 200000000)
+        return None if index is None else self._company(index)[0]
+
+    def filing(self, reference: str) -> dict | None:
+        # Reference numbers are '{year}-{index:08d}-{I|C}'
+        parts = reference.split("-")
+        if len(parts) != 3 or not parts[1].isdigit():
+            return None
+        index = self._index(int(parts[1]))
+        return None if index is None else self._company(index)[1].get(
+            reference)
+
+    def batch(self, date: str) -> list[dict]:
+        """Return the references deposited on date."""
+        with self._lock:
+            if self._batches is None:
+                self._batches = {}
+                for index in range(self.companies):
+                    for ref in self._company(index)[0]:
+                        self._batches.setdefault(
+                            ref["DepositDate"], []).append(ref)
+        return self._batches.get(date, [])
+
+
+class StoreSource:
+    """The reference lists and filings of stores in folder, as written by
+    'initial_fetch.py' ('temp_references' and 'temp_filing')."""
+    def __init__(self, folder, *, packed=False):
+        self.ref_store = open_store(f"{folder}/temp_references", packed=packed)
+        self.filing_store = open_store(f"{folder}/temp_filing", packed=packed)
+        self._lock = threading.Lock()
+        self._batches: dict[str, list[dict]] | None = None
+
+    def enterprise_ids(self) -> list[str]:
+        return sorted(self.ref_store.keys())
+
+    def references(self, enterprise_id: str) -> list[dict] | None:
+        with self._lock:
+            data = self.ref_store.get(enterprise_id)
+        return None if data is None else json.loads(data)
+
+    def filing(self, reference: str) -> dict | None:
+        with self._lock:
+            data = self.filing_store.get(reference)
+        return None if data is None else json.loads(data)
+
+    def batch(self, date: str) -> list[dict]:
+        """Return the references deposited on date."""
+        with self._lock:
+            if self._batches is None:
+                self._batches = {}
+                for key in self.ref_store.keys():
+                    for ref in json.loads(self.ref_store.get(key)):
+                        self._batches.setdefault(
+                            ref.get("DepositDate"), []).append(ref)
+        return self._batches.get(date, [])
+
+
+class Faults:
+    """
+    Random latency and errors added to every response.
+
+    Params:
+    - latency, jitter: delay in seconds, uniform in latency +- jitter.
+    - rate_429: share of requests answered 429 Too Many Requests, with a
+      Retry-After of retry_after seconds.
+    - rate_5xx: share of requests answered 500, 502 or 503.
+    - seed: seed of the generator, the same seed gives the same faults for
+      the same order of requests.
+    """
+    def __init__(
+        self,
+        *,
+        latency=0.0,
+        jitter=0.0,
+        rate_429=0.0,
+        rate_5xx=0.0,
+        retry_after=1,
+        seed=0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self) -> tuple[float, int | None]:
+        """Return the delay and the error status, None for no error, of the
+        next request."""
+        with self._lock:
+            delay = max(
+                self.latency + self.rng.uniform(-self.jitter, self.jitter), 0)
+            roll = self.rng.random()
+            if roll < self.rate_429:
+                return delay, 429
+            if roll < self.rate_429 + self.rate_5xx:
+                return delay, self.rng.choice((500, 502, 503))
+            return delay, None
+
+
+ROUTES = [
+    (re.compile(r"^/authentic/legalEntity/(\d+)/references$"), "references"),
+    (re.compile(r"^/authentic/deposit/([^/]+)/accountingData$"), "filing"),
+    (re.compile(r"^/extracts/batch/([\d-]+)/references$"), "batch"),
+    (re.compile(r"^/extracts/batch/([\d-]+)/accountingData$"), "batch_data"),
+]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers GET requests from server.source, after server.faults."""
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def do_GET(self):
+        delay, error = self.server.faults.draw()
+        if delay:
+            time.sleep(delay)
+        if error == 429:
+            self._send(
+                429, {"message": "Too many requests"},
+                {"Retry-After": str(self.server.faults.retry_after)})
+            return
+        if error:
+            self._send(error, {"message": "Injected server error"})
+            return
+
+        path = self.path.split("?", 1)[0]
+        for pattern, route in ROUTES:
+            match = pattern.match(path)
+            if match:
+                body = getattr(self, f"_{route}")(match[1])
+                break
+        else:
+            body = None
+
+        if body is None:
+            self._send(404, {"message": "Not found"})
+        else:
+            self._send(200, body, content_type=(
+                "application/x.jsonxbrl"
+                if path.endswith("accountingData")
+                else "application/json"))
+
+    def _references(self, enterprise_id):
+        refs = self.server.source.references(enterprise_id)
+        if refs is None:
+            return None
+        return [self._with_url(ref) for ref in refs]
+
+    def _filing(self, reference):
+        return self.server.source.filing(reference)
+
+    def _batch(self, date):
+        refs = self.server.source.batch(date)
+        return [self._with_url(ref) for ref in refs] or None
+
+    def _batch_data(self, date):
+        filings = [
+            self.server.source.filing(ref["ReferenceNumber"])
+            for ref in self.server.source.batch(date)
+            ]
+        return [f for f in filings if f is not None] or None
+
+    def _with_url(self, ref: dict) -> dict:
+        """Return ref with its AccountingDataURL on this server."""
+        host = self.headers.get("Host") or "%s:%s" % self.server.server_address
+        return ref | {
+            "AccountingDataURL": (
+                f"http://{host}/authentic/deposit/"
+                f"{ref['ReferenceNumber']}/accountingData")
+        }
+
+    def _send(self, status, body, headers=None, *, content_type=None):
+        data = json.dumps(body).encode()
+        encoding = None
+        if (
+            len(data) > 1024
+            and "gzip" in self.headers.get("Accept-Encoding", "")
+        ):
+            data = gzip.compress(data, compresslevel=1)
+            encoding = "gzip"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type or "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count(status)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MockServer(ThreadingHTTPServer):
+    """Threaded mock of the CBSO API, one thread per connection."""
+    daemon_threads = True
+
+    def __init__(self, address, source, faults=None, *, verbose=False):
+        super().__init__(address, MockHandler)
+        self.source = source
+        self.faults = faults or Faults()
+        self.verbose = verbose
+        self.statuses: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        """The NBB_BASE_URL of this server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def count(self, status: int):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def serve_in_thread(source, faults=None, *, host="127.0.0.1", port=0):
+    """Start a MockServer on a background thread and return it. Port 0 picks
+    a free port, see server.base_url. Stop it with server.shutdown()."""
+    server = MockServer((host, port), source, faults)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a local mock of the NBB CBSO API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--replay", default=None,
+        help="folder with the stores to serve instead of synthetic data")
+    parser.add_argument("--packed", action="store_true")
+    parser.add_argument("--companies", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--rubrics", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--csv", default=None,
+        help="write the enterprise ids served to this csv, for the fetchers")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.replay:
+        source = StoreSource(args.replay, packed=args.packed)
+    else:
+        source = SyntheticSource(
+            args.companies, seed=args.seed, years=args.years,
+            rubrics=args.rubrics)
+
+    if args.csv:
+        with open(args.csv, "w") as file:
+            file.writelines(f"{ent}\n" for ent in source.enterprise_ids())
+
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        retry_after=args.retry_after,
+        seed=args.seed
+        )
+    server = MockServer(
+        (args.host, args.port), source, faults, verbose=args.verbose)
+    print(
+        f"Mock CBSO API on {server.base_url}, "
+        f"NBB_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Responses per status: {dict(sorted(server.statuses.items()))}")
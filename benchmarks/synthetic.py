@@ -0,0 +1,320 @@
+###############################################################################
+# Generator of synthetic NBB data, shaped like the reference lists and the
+# JSONXBRL filings returned by the CBSO authentic API.
+#
+# A company gets one reference list and one filing per account year, with
+# configurable counts of persons, representatives, shareholders and rubrics.
+# Persons are drawn from a small pool, so the same person is met again in
+# later years and in other companies, spelled slightly differently now and
+# then, like in real filings. The same seed always gives the same data.
+#
+# Write a dataset to stores, the layout read by 'initial_pop.py':
+# python -m benchmarks.synthetic bench_data --companies 500 --rubrics 800
+#
+###############################################################################
+
+import json
+import random
+import argparse
+
+from nbb_data.store import open_store
+
+
+FIRST_NAMES = [
+    "Jan", "Marie", "Pieter", "Sofie", "Luc", "An", "Koen", "Els", "Tom",
+    "Lieve", "Dirk", "Nathalie", "Jean-Pierre", "Françoise", "Michel",
+    "Véronique", "Geert", "Ingrid", "Wouter", "Ann-Sophie"
+]
+LAST_NAMES = [
+    "Peeters", "Janssens", "Maes", "Jacobs", "Mertens", "Willems", "Claes",
+    "Goossens", "Wouters", "De Smet", "Dubois", "Lambert", "Dupont",
+    "Van den Broeck", "Vermeulen", "Lemmens", "De Clercq", "Martens",
+    "Desmet", "Leclercq"
+]
+STREETS = [
+    "Kerkstraat", "Stationsstraat", "Dorpstraat", "Rue de la Station",
+    "Nieuwstraat", "Molenstraat", "Rue de l'Église", "Schoolstraat",
+    "Avenue Louise", "Grote Markt"
+]
+OTHER_COUNTRIES = ["Frankrijk", "Nederland", "Duitsland", "Luxemburg"]
+FUNCTIONS = ["10", "11", "12", "13", "14", "17"]
+MODEL_TYPES = ["m01-f", "m02-f", "m07-f", "m81-f"]
+
+
+def enterprise_number(index: int) -> str:
+    """Return a formatted enterprise number, e.g. '0200.000.012'."""
+    digits = f"{200000000 + index:010d}"
+    return f"{digits[:4]}.{digits[4:7]}.{digits[7:]}"
+
+
+def person(rng: random.Random, pool: int, typo=0.05) -> dict:
+    """Return a person drawn from the first 'pool' persons."""
+    i = rng.randrange(pool)
+    first = FIRST_NAMES[i % len(FIRST_NAMES)]
+    last = LAST_NAMES[i // len(FIRST_NAMES) % len(LAST_NAMES)]
+    if rng.random() < typo:
+        cut = rng.randrange(len(last))
+        last = last[:cut] + last[cut + 1:]
+
+    address = {
+        "Street": STREETS[i % len(STREETS)],
+        "Number": str(i % 97 + 1)
+    }
+    if i % 10:
+        address["City"] = f"pcd:m{1000 + i % 8999}"
+        address["Country"] = "cty:mBE"
+    else:
+        address["OtherPostalCode"] = f"{i % 99999:05d}"
+        address["OtherCountry"] = OTHER_COUNTRIES[i % len(OTHER_COUNTRIES)]
+
+    return {"FirstName": first, "LastName": last, "Address": address}
+
+
+def entity(rng: random.Random, pool: int) -> dict:
+    """Return a legal person drawn from the first 'pool' entities."""
+    i = rng.randrange(pool)
+    address = {"Street": STREETS[i % len(STREETS)], "Number": str(i % 50 + 1)}
+    if i % 4:
+        address["City"] = f"pcd:m{1000 + i % 8999}"
+        address["Country"] = "cty:mBE"
+    else:
+        address["OtherCountry"] = OTHER_COUNTRIES[i % len(OTHER_COUNTRIES)]
+
+    return {
+        "Identifier": f"BE {enterprise_number(900000 + i)}",
+        "Name": f"Holding {i} NV",
+        "Address": address
+    }
+
+
+def mandate(rng: random.Random, year: int) -> dict:
+    start = year - rng.randrange(10)
+    dates = {"StartDate": f"{start}-0{rng.randrange(1, 10)}-01"}
+    if rng.random() < 0.3:
+        dates["EndDate"] = f"{year + rng.randrange(1, 6)}-06-30"
+    return {
+        "FunctionMandate": f"fct:m{rng.choice(FUNCTIONS)}",
+        "MandateDates": dates
+    }
+
+
+def reference(index: int, year: int, deposit_type="Initial") -> dict:
+    month = "09" if deposit_type == "Correction" else "06"
+    return {
+        "EnterpriseNumber": enterprise_number(index),
+        "EnterpriseName": f"Company {index} BV",
+        "LegalSituation": "000",
+        "ReferenceNumber": f"{year + 1}-{index:08d}-{deposit_type[0]}",
+        "DepositType": deposit_type,
+        "DepositDate": f"{year + 1}-{month}-15",
+        "ExerciseDates": {
+            "startDate": f"{year}-01-01",
+            "endDate": f"{year}-12-31"
+        },
+        "ModelType": MODEL_TYPES[index % len(MODEL_TYPES)],
+        "LegalForm": "610",
+        "ActivityCode": f"{62010 + index % 20}"
+    }
+
+
+def filing(
+    rng: random.Random,
+    ref: dict,
+    *,
+    persons: int,
+    legal_persons: int,
+    representatives: int,
+    participations: int,
+    shareholders: int,
+    rubrics: int,
+    person_pool: int,
+    entity_pool: int
+) -> dict:
+    """Return the JSONXBRL filing of reference ref."""
+    year = int(ref["ExerciseDates"]["endDate"][:4])
+    codes = sorted(rng.sample(range(10, 10 + 4 * rubrics), rubrics))
+
+    return {
+        "ReferenceNumber": ref["ReferenceNumber"],
+        "EnterpriseName": ref["EnterpriseName"],
+        "Address": {"Street": "Kerkstraat", "Number": "1",
+                    "City": "pcd:m2000", "Country": "cty:mBE"},
+        "LegalForm": {"Code": ref["LegalForm"]},
+        "JointCommittees": [],
+        "Administrators": {
+            "NaturalPersons": [
+                {
+                    "Person": person(rng, person_pool),
+                    "Mandates": [mandate(rng, year)]
+                }
+                for _ in range(persons)
+            ],
+            "LegalPersons": [
+                {
+                    "Entity": entity(rng, entity_pool),
+                    "Representatives": [
+                        person(rng, person_pool)
+                        for _ in range(representatives)
+                    ],
+                    "Mandates": [mandate(rng, year)]
+                }
+                for _ in range(legal_persons)
+            ]
+        },
+        "ParticipatingInterests": [
+            {
+                "Entity": entity(rng, entity_pool),
+                "AccountDate": f"{year}-12-31",
+                "Currency": "ccy:mEUR",
+                "Equity": f"{rng.randrange(10**4, 10**8)}.00",
+                "NetResult": f"{rng.randrange(-10**6, 10**7)}.00",
+                "ParticipatingInterestHeld": [{
+                    "Nature": "Aandelen",
+                    "Line": "280",
+                    "Number": rng.randrange(1, 10000),
+                    "PercentageDirectlyHeld": round(rng.uniform(1, 100), 2)
+                }]
+            }
+            for _ in range(participations)
+        ],
+        "Shareholders": {
+            "EntityShareHolders": [
+                {
+                    "Entity": entity(rng, entity_pool),
+                    "RightsHeld": [{
+                        "Nature": "Aandelen",
+                        "Line": "1",
+                        "NumberSecuritiesAttached": rng.randrange(1, 10000),
+                        "Percentage": round(rng.uniform(1, 100), 2)
+                    }]
+                }
+                for _ in range(shareholders)
+            ]
+        },
+        "Rubrics": [
+            {
+                "Code": str(code),
+                "Period": period,
+                "Value": f"{rng.randrange(-10**7, 10**9) / 100:.2f}"
+            }
+            for code in codes
+            for period in ("N", "NM1")
+        ]
+    }
+
+
+def company(
+    index: int,
+    *,
+    seed=0,
+    years=3,
+    first_year=2021,
+    corrections=0.1,
+    persons=4,
+    legal_persons=1,
+    representatives=1,
+    participations=2,
+    shareholders=2,
+    rubrics=400,
+    person_pool=2000,
+    entity_pool=500
+) -> tuple[list[dict], dict[str, dict]]:
+    """
+    Return the reference list of company 'index' and its filings, keyed by
+    reference number. The same index and seed always give the same company.
+
+    Params:
+    - years: account years, starting at first_year.
+    - corrections: share of the years with a correction deposited later.
+    - persons, legal_persons, representatives (per legal person),
+      participations, shareholders, rubrics: counts per filing. Rubrics
+      come in pairs, one for period 'N' and one for 'NM1'.
+    - person_pool, entity_pool: number of distinct persons and entities the
+      filings are drawn from.
+    """
+    rng = random.Random(f"{seed}-{index}")
+    refs = []
+    for year in range(first_year, first_year + years):
+        refs.append(reference(index, year))
+        if rng.random() < corrections:
+            refs.append(reference(index, year, "Correction"))
+
+    filings = {
+        ref["ReferenceNumber"]: filing(
+            rng, ref,
+            persons=persons,
+            legal_persons=legal_persons,
+            representatives=representatives,
+            participations=participations,
+            shareholders=shareholders,
+            rubrics=rubrics,
+            person_pool=person_pool,
+            entity_pool=entity_pool
+            )
+        for ref in refs
+        }
+    return refs, filings
+
+
+def country_codes() -> dict[str, str]:
+    """Return the country names used in OtherCountry, as read from the
+    countries table."""
+    return {"Frankrijk": "FR", "Nederland": "NL", "Duitsland": "DE",
+            "Luxemburg": "LU"}
+
+
+def write_dataset(folder, companies: int, *, packed=False, **params) -> int:
+    """
+    Write companies to '{folder}/temp_references' and '{folder}/temp_filing'
+    and return the number of filings written. params go to company().
+    """
+    ref_store = open_store(f"{folder}/temp_references", packed=packed)
+    filing_store = open_store(f"{folder}/temp_filing", packed=packed)
+    count = 0
+    try:
+        for index in range(companies):
+            refs, filings = company(index, **params)
+            ref_store.put(
+                refs[0]["EnterpriseNumber"].replace(".", ""),
+                json.dumps(refs, indent=4).encode()
+                )
+            for key, data in filings.items():
+                filing_store.put(key, json.dumps(data).encode())
+            count += len(filings)
+    finally:
+        ref_store.close()
+        filing_store.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic NBB dataset to stores.")
+    parser.add_argument("folder")
+    parser.add_argument("--companies", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--persons", type=int, default=4)
+    parser.add_argument("--legal-persons", type=int, default=1)
+    parser.add_argument("--representatives", type=int, default=1)
+    parser.add_argument("--participations", type=int, default=2)
+    parser.add_argument("--shareholders", type=int, default=2)
+    parser.add_argument("--rubrics", type=int, default=400)
+    parser.add_argument("--packed", action="store_true")
+    args = parser.parse_args()
+
+    count = write_dataset(
+        args.folder,
+        args.companies,
+        packed=args.packed,
+        seed=args.seed,
+        years=args.years,
+        persons=args.persons,
+        legal_persons=args.legal_persons,
+        representatives=args.representatives,
+        participations=args.participations,
+        shareholders=args.shareholders,
+        rubrics=args.rubrics
+        )
+    print(
+        f"Wrote {args.companies} companies, {count} filings to {args.folder}")
@@ -1,4 +1,8 @@
+import os
+import atexit
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 
 class ScriptLogger:
@@ -9,6 +13,14 @@ class ScriptLogger:
     - 30 = WARNING
     - 20 = INFO
     - 10 = DEBUG
+
+    Params:
+    - queued: hand records to a background thread that writes them, so a
+      log call never waits on the disk. Threads and forked processes share
+      the same queue and its single writer, lines are neither interleaved
+      nor lost. The queue is flushed on exit or by close().
+    - max_bytes: rotate the file once it grows past max_bytes, keeping
+      backup_count old files. 0 never rotates.
     """
     def __init__(
         self,
@@ -16,13 +28,45 @@ class ScriptLogger:
         *,
         level=20,
         format='%(asctime)s [%(levelname)s] %(message)s',
-        filemode='w'
+        filemode='w',
+        queued=False,
+        max_bytes=0,
+        backup_count=5
     ):
         self.log = logging.getLogger(target_file)
         self.log.setLevel(level)
+        self.listener = None
 
         if not self.log.handlers:  # Prevent adding handlers multiple times
-            handler = logging.FileHandler(target_file, mode=filemode)
+            if max_bytes:
+                handler = RotatingFileHandler(
+                    target_file,
+                    mode=filemode,
+                    maxBytes=max_bytes,
+                    backupCount=backup_count
+                    )
+            else:
+                handler = logging.FileHandler(target_file, mode=filemode)
             formatter = logging.Formatter(format)
             handler.setFormatter(formatter)
-            self.log.addHandler(handler)
+
+            if queued:
+                # A multiprocessing queue, so forked workers log through it
+                queue = multiprocessing.Queue(-1)
+                self.listener = QueueListener(queue, handler)
+                self.listener.start()
+                self._owner = os.getpid()
+                self.log.addHandler(QueueHandler(queue))
+                atexit.register(self.close)
+            else:
+                self.log.addHandler(handler)
+
+    def close(self):
+        """Write the queued records and stop the writer. Only the process
+        that created the logger owns the writer."""
+        if self.listener is None or os.getpid() != self._owner:
+            return
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
@@ -0,0 +1,220 @@
+import argparse
+from datetime import date
+from itertools import chain
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from nbb_data.classes import NBBConnector
+from nbb_data.models import (
+    metadata, table_facts, facts_partitioned, compact_facts
+)
+
+
+def facts_partition_ddl(first_year: int, last_year: int) -> list[str]:
+    """
+    Return the DDL creating one statement_facts partition per account year
+    from first_year to last_year, plus a default partition for the others.
+    In the wide layout account_year is a string, so the bounds are too.
+    """
+    name = table_facts.name
+    quote = "" if compact_facts else "'"
+    ddl = [
+        f"CREATE TABLE IF NOT EXISTS {name}_{year} PARTITION OF {name} "
+        f"FOR VALUES FROM ({quote}{year}{quote}) TO "
+        f"({quote}{year + 1}{quote})"
+        for year in range(first_year, last_year + 1)
+        ]
+    ddl.append(
+        f"CREATE TABLE IF NOT EXISTS {name}_default PARTITION OF {name} "
+        "DEFAULT")
+    return ddl
+
+
+def existing_keys(inspector, table_name) -> list[tuple]:
+    """
+    Return the unique keys of table_name in the database as (name, columns,
+    nulls_not_distinct), from its unique constraints and its unique indexes,
+    whatever their names. Expression indexes are left out.
+    """
+    keys = {}
+    for key in chain(
+        inspector.get_unique_constraints(table_name),
+        (i for i in inspector.get_indexes(table_name) if i["unique"])
+    ):
+        if key["name"] in keys or None in key["column_names"]:
+            continue
+        keys[key["name"]] = (
+            key["name"],
+            key["column_names"],
+            bool(key.get("dialect_options", {}).get(
+                "postgresql_nulls_not_distinct"))
+            )
+    return list(keys.values())
+
+
+def missing_keys(table, keys: list[tuple]) -> tuple[list, list[str]]:
+    """
+    Compare the unique constraints of table with its existing keys (see
+    existing_keys). Return the constraints to add and the problems found.
+
+    A constraint is added unless a key on the same columns exists, under
+    any name: the upserts only need one. A key on fewer of its columns is
+    reported, it rejects rows the upserts expect to keep, as is an
+    equivalent key that treats NULLs as distinct.
+    """
+    add, problems = [], []
+    for constraint in table.constraints:
+        if not constraint.name or not constraint.name.startswith("uq_"):
+            continue
+        columns = [c.name for c in constraint.columns]
+        nulls_not_distinct = bool(
+            constraint.dialect_options["postgresql"]["nulls_not_distinct"])
+
+        equivalent = [k for k in keys if set(k[1]) == set(columns)]
+        narrower = [k for k in keys if set(k[1]) < set(columns)]
+        for name, key_columns, _ in narrower:
+            problems.append((
+                f"{name} of {table.name} is unique on {key_columns}, a part "
+                f"of {columns}, and rejects rows the upserts keep. Drop it."
+            ))
+
+        if equivalent:
+            name, _, key_nulls_not_distinct = equivalent[0]
+            if nulls_not_distinct and not key_nulls_not_distinct:
+                problems.append((
+                    f"{name} of {table.name} on {columns} treats NULLs as "
+                    "distinct, rows with NULLs never conflict. Recreate it "
+                    "with NULLS NOT DISTINCT."
+                ))
+            continue
+
+        same_name = [k for k in keys if k[0] == constraint.name]
+        if same_name:
+            problems.append((
+                f"{constraint.name} of {table.name} is on {same_name[0][1]}, "
+                f"the upserts expect {columns}. Drop it to have it recreated."
+            ))
+            continue
+        add.append(constraint)
+    return add, problems
+
+
+def bootstrap(engine, *, first_year=2021, last_year=None) -> list[str]:
+    """
+    Create the missing tables, unique constraints and indexes of
+    nbb_data.models, and the statement_facts partitions when partitioned.
+    Existing tables are kept: a constraint that cannot be added, e.g. because
+    of duplicate rows, is reported and skipped, as is a year partition that
+    rows in the default partition already fall into. Existing keys and
+    indexes on the same columns are used as they are, whatever their name,
+    see missing_keys. Return the problems found.
+
+    On another database, e.g. SQLite, only the missing tables and indexes
+    are created. An index that cannot be created, e.g. a unique index of
+    models.sqlite_keys over rows loaded before it existed, is reported.
+    """
+    last_year = last_year or date.today().year + 2
+    problems = []
+
+    if engine.dialect.name != "postgresql":
+        metadata.create_all(engine)
+        # Expression indexes are not reflected, checkfirst would miss them
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(CreateIndex(index, if_not_exists=True))
+                except Exception as e:
+                    problems.append((
+                        f"Could not create {index.name} of {table.name}, "
+                        f"remove its duplicate rows first. Error {e}"
+                    ))
+        return problems
+
+    with engine.connect() as conn:
+        existing = set(inspect(conn).get_table_names())
+
+    metadata.create_all(engine)
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+
+        with engine.connect() as conn:
+            inspector = inspect(conn)
+            keys = existing_keys(inspector, table.name)
+            indexes = {
+                (tuple(i["column_names"]), i["unique"])
+                for i in inspector.get_indexes(table.name)
+                }
+            columns = {c["name"] for c in inspector.get_columns(table.name)}
+            partitioned = conn.execute(
+                text(
+                    "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+                    "JOIN pg_class c ON c.oid = p.partrelid "
+                    "WHERE c.relname = :name)"),
+                {"name": table.name}
+                ).scalar()
+
+        missing = [c.name for c in table.columns if c.name not in columns]
+        if missing:
+            problems.append((
+                f"{table.name} exists without columns {missing}, e.g. from "
+                "another NBB_FACTS_LAYOUT. Add or recreate them."
+            ))
+            continue
+
+        add, key_problems = missing_keys(table, keys)
+        problems.extend(key_problems)
+        for constraint in add:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(AddConstraint(constraint))
+            except Exception as e:
+                problems.append(
+                    f"Could not add {constraint.name} to {table.name}: {e}")
+
+        for index in table.indexes:
+            columns = tuple(c.name for c in index.columns)
+            if (columns, index.unique) not in indexes:
+                index.create(engine, checkfirst=True)
+
+        if table is table_facts and facts_partitioned and not partitioned:
+            problems.append((
+                f"{table.name} exists and is not partitioned. Recreate it "
+                "to partition it by account_year."
+            ))
+
+    if facts_partitioned:
+        for ddl in facts_partition_ddl(first_year, last_year):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(ddl))
+            except Exception as e:
+                problems.append(f"Could not create partition: {e}")
+
+    return problems
+
+
+if __name__ == "__main__":
+    # Create or complete the schema of the database in .env:
+    # NBB_FACTS_PARTITIONED=1 python -m nbb_data.bootstrap --first-year 2021
+    parser = argparse.ArgumentParser(
+        description="Create the nbb_data tables, constraints and indexes.")
+    parser.add_argument("--first-year", type=int, default=2021)
+    parser.add_argument(
+        "--last-year", type=int, default=None,
+        help="last account year with its own partition, default in 2 years")
+    args = parser.parse_args()
+
+    nbb = NBBConnector(isolation="READ COMMITTED")
+    problems = bootstrap(
+        nbb.engine, first_year=args.first_year, last_year=args.last_year)
+    for problem in problems:
+        print(problem)
+    print(
+        "Schema ready"
+        + (", statement_facts partitioned" if facts_partitioned else "")
+        + (f", {len(problems)} problems" if problems else "")
+        )
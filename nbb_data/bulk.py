@@ -0,0 +1,120 @@
+import io
+
+from sqlalchemy import MetaData, Table, Column, BigInteger, select
+from sqlalchemy.dialects.postgresql import insert
+
+from .classes import CleanedData
+from .models import table_facts, table_statements, compact_facts
+from .population import (
+    UPSERTS, FACT_ROW_KEYS, company_rows, on_conflict, upsert_counts,
+    fact_row_columns, compact_facts_select, replaced_facts
+)
+
+
+def _copy_text(value) -> str:
+    """Return value in the text format of COPY."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class BulkLoader:
+    """
+    Collect the rows of many companies and load them table by table with
+    COPY FROM STDIN into a temporary staging table, followed by one
+    INSERT ... SELECT ... ON CONFLICT per table.
+
+    The merge follows the same UPSERTS rules as the per-company statements.
+    Rows sharing a conflict key within one batch are collapsed to the last
+    one added, as if the companies had been written one after the other.
+    PostgreSQL only.
+    """
+    def __init__(self):
+        self.companies: list[str] = []
+        self.rows: dict[str, list[dict]] = {
+            table.name: [] for table, _, _ in UPSERTS}
+
+    def __len__(self) -> int:
+        return len(self.companies)
+
+    def add(self, cleaned: CleanedData):
+        self.companies.append(cleaned.company_info["enterprise_id"])
+        for name, rows in company_rows(cleaned).items():
+            self.rows[name].extend(rows)
+
+    def clear(self):
+        self.companies.clear()
+        for rows in self.rows.values():
+            rows.clear()
+
+    def flush(self, conn) -> dict[str, int]:
+        """
+        Load all collected rows within the transaction of conn. Return the
+        rows inserted, updated and unchanged per table, see upsert_counts.
+        """
+        counts = {}
+        for table, keys, update in UPSERTS:
+            if self.rows[table.name]:
+                counts |= self._load(
+                    conn, table, self.rows[table.name], keys, update)
+        self.clear()
+        return counts
+
+    def _load(self, conn, table, rows, keys, update) -> dict[str, int]:
+        # Compact facts are staged as rows and swapped for keys on merge
+        compact = compact_facts and table is table_facts
+        columns = (
+            fact_row_columns() if compact
+            else [Column(c.name, c.type) for c in table.columns]
+            )
+        cols = [c.name for c in columns if c.name in rows[0]]
+        stage = Table(
+            f"stage_{table.name}", MetaData(),
+            *columns,
+            Column("_seq", BigInteger),
+            prefixes=["TEMPORARY"],
+            postgresql_on_commit="DROP"
+            )
+        stage.create(conn)
+
+        buffer = io.StringIO()
+        for seq, row in enumerate(rows):
+            buffer.write("\t".join(_copy_text(row.get(c)) for c in cols))
+            buffer.write(f"\t{seq}\n")
+        buffer.seek(0)
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {stage.name} ({', '.join(cols)}, _seq) FROM STDIN",
+                buffer
+                )
+        finally:
+            cursor.close()
+
+        source = select(*(stage.c[c] for c in cols))
+        row_keys = FACT_ROW_KEYS if compact else keys
+        submitted = len(rows)
+        if update:
+            source = source.distinct(*(stage.c[k] for k in row_keys)).order_by(
+                *(stage.c[k] for k in row_keys), stage.c._seq.desc())
+            submitted = len({tuple(r.get(k) for k in row_keys) for r in rows})
+        else:
+            source = source.order_by(stage.c._seq)
+
+        if compact:
+            cols = [c.name for c in table.columns]
+            source = compact_facts_select(source.subquery())
+        stmt = insert(table).from_select(cols, source)
+        if compact_facts and table is table_statements:
+            stmt = stmt.add_cte(replaced_facts(stage))
+        result = conn.execute(on_conflict(stmt, keys, update))
+        counts = upsert_counts(table, result, submitted)
+        stage.drop(conn)
+        return counts
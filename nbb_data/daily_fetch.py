@@ -0,0 +1,190 @@
+###############################################################################
+# This script fetches only the deposits published since the last sync.
+#
+# Instead of querying the reference list of every tracked enterprise, it reads
+# the daily 'extracts' reference batches and keeps the enterprises listed in
+# the CSV file. Run it daily after a first 'initial_fetch.py'.
+#
+# Step 1: Read enterprise ids and retry the filings that failed before.
+# Step 2: For every day since the last sync, fetch the extracts references.
+# Step 3: Keep references of tracked enterprises where year >= 2021 and merge
+#         them into the reference file in 'temp_references'.
+# Step 4: Fetch the new filings to 'temp_filing'.
+# Step 5: Record the day as synced in the journal.
+#
+# It shares 'fetch_journal.jsonl' with 'initial_fetch.py', so a filing fetched
+# by either script is never fetched twice. A day is only recorded once its
+# reference batch was read and merged; a failing batch or reference file
+# stops the run so the next run starts again from that day.
+#
+# Set 'packed' the same way as in 'initial_fetch.py'.
+#
+###############################################################################
+
+import os
+import csv
+import json
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from log_config import ScriptLogger
+from nbb_data.classes import URLgen_nbb, NBBClient
+from nbb_data.journal import FetchJournal
+from nbb_data.store import open_store
+
+
+workers = 8  # filings downloaded concurrently
+initial_days = 7  # days to look back when the journal has no sync yet
+packed = False  # write to packed stores instead of json files
+
+delta_logger = ScriptLogger("logs/delta_url.log", level=20, queued=True)
+
+journal = FetchJournal("fetch_journal.jsonl")
+ref_store = open_store("temp_references", packed=packed)
+filing_store = open_store("temp_filing", packed=packed)
+client = NBBClient(pool_size=workers)
+extracts = NBBClient(
+    api_key=os.getenv("API_KEY_EXTRACTS") or os.getenv("API_KEY_AUTHENTIC"),
+    pool_size=2
+    )
+ref_lock = threading.Lock()
+
+# Step 1
+with open("server4.csv", newline="") as csvfile:
+    read = csv.reader(csvfile)
+    tracked = {x[0].replace(".", "") for x in read}
+
+
+def fetch_filing(ref: str, ent: str | None = None) -> bool:
+    """Download one filing through the authentic deposit endpoint."""
+    url = URLgen_nbb(db="authentic", request="accData", ref_id=ref).url
+    try:
+        status = client.download(url, filing_store, ref)
+    except Exception as e:
+        delta_logger.log.error(f"For {ent} - {ref}: {e}")
+        status = None
+
+    if status != 200:
+        if status is not None:
+            delta_logger.log.warning(f"Status: {status} for {ent} - {ref}")
+        journal.record_filing(ref, journal.FAILED, enterprise_id=ent)
+        return False
+
+    journal.record_filing(ref, journal.OK, enterprise_id=ent)
+    return True
+
+
+def merge_references(ent: str, new_refs: list[dict]):
+    """Add new_refs to the reference file of ent, sorted by end date."""
+    with ref_lock:
+        data = ref_store.get(ent)
+        refs = json.loads(data) if data else []
+
+        known = {r.get("ReferenceNumber") for r in refs}
+        refs.extend(r for r in new_refs if r["ReferenceNumber"] not in known)
+        refs.sort(key=lambda x: x["ExerciseDates"]["endDate"])
+
+        ref_store.put(ent, json.dumps(refs, indent=4).encode())
+
+
+retry = journal.failed_filings()
+with ThreadPoolExecutor(max_workers=workers) as pool:
+    retried = sum(pool.map(fetch_filing, retry))
+delta_logger.log.info(f"{retried} of {len(retry)} failed filings recovered.")
+
+# Step 2
+last = journal.last_sync()
+day = (
+    datetime.strptime(last, "%Y-%m-%d") + timedelta(days=1)
+    if last
+    else datetime.today() - timedelta(days=initial_days)
+    )
+
+queued = 0
+fetched = 0
+while True:
+    date = day.strftime("%Y-%m-%d")
+    try:
+        resp = extracts.extracts_references(date)
+    except ValueError:
+        break  # URLgen_nbb only accepts days before yesterday
+    except Exception as e:
+        delta_logger.log.error(f"No response for batch {date}: {e}")
+        break
+
+    if resp.status_code == 404:
+        journal.record_sync(date, journal.OK)  # nothing published that day
+        day += timedelta(days=1)
+        continue
+
+    try:
+        json_data = resp.json() if resp.status_code == 200 else None
+    except ValueError:
+        json_data = None
+    if not isinstance(json_data, list):
+        delta_logger.log.error(
+            f"Status {resp.status_code} or invalid JSON for batch {date}.")
+        break
+
+    # Step 3
+    per_ent: dict[str, list[dict]] = {}
+    for r in json_data:
+        ent = "".join(c for c in r.get("EnterpriseNumber", "") if c.isdigit())
+        try:
+            keep = (
+                ent in tracked
+                and not journal.filing_done(r["ReferenceNumber"])
+                and datetime.strptime(
+                    r["ExerciseDates"]["endDate"], "%Y-%m-%d").year >= 2021
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            delta_logger.log.error(f"Invalid reference in {date}: {e}")
+            continue
+        if keep:
+            per_ent.setdefault(ent, []).append(r)
+
+    # Filings of a reference file that failed to merge are not fetched: the
+    # population reads filings from the reference files only.
+    unmerged = []
+    for ent, refs in per_ent.items():
+        try:
+            merge_references(ent, refs)
+        except Exception as e:
+            delta_logger.log.error(
+                f"While writing references file. {ent} - {e}")
+            unmerged.append(ent)
+    for ent in unmerged:
+        del per_ent[ent]
+
+    # Step 4
+    jobs = [
+        (r["ReferenceNumber"], ent)
+        for ent, refs in per_ent.items()
+        for r in refs
+        ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetched += sum(pool.map(lambda job: fetch_filing(*job), jobs))
+    queued += len(jobs)
+
+    if unmerged:
+        delta_logger.log.error((
+            f"Batch {date} not synced, references of {unmerged} not merged. "
+            "The next run starts again from that day."
+        ))
+        break
+
+    # Step 5
+    journal.record_sync(date, journal.OK)
+    delta_logger.log.info(
+        f"Batch {date}: {len(json_data)} references, {len(jobs)} queued.")
+    day += timedelta(days=1)
+
+delta_logger.log.info(f"{fetched} of {queued} new filings fetched.")
+delta_logger.log.info(f"Synced up to {journal.last_sync()}.")
+
+client.close()
+extracts.close()
+journal.close()
+ref_store.close()
+filing_store.close()
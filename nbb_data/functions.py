@@ -1,25 +1,48 @@
 import re
 import unicodedata
+from functools import lru_cache
 from typing import Iterable
 
 from rapidfuzz import fuzz
 
 
+_NOT_LETTER = re.compile(r"[^a-z]")
+_NOT_LETTER_DIGIT = re.compile(r"[^a-z0-9]")
+
+# str.translate tables deleting every ASCII character that is not kept
+_ASCII_LETTER = {
+    i: None for i in range(128) if not "a" <= chr(i) <= "z"}
+_ASCII_LETTER_DIGIT = {
+    i: None for i in _ASCII_LETTER if not "0" <= chr(i) <= "9"}
+
+
+@lru_cache(maxsize=1 << 16)
+def _normalise(string: str, digits: bool) -> str:
+    string = string.lower()
+    if string.isascii():
+        # NFKD and accent removal leave ASCII unchanged
+        return string.translate(
+            _ASCII_LETTER_DIGIT if digits else _ASCII_LETTER)
+
+    # Combining accents are not in [a-z], the final sub drops them too
+    string = unicodedata.normalize("NFKD", string).replace("ß", "ss")
+    if digits:
+        return _NOT_LETTER_DIGIT.sub("", string)
+    return _NOT_LETTER.sub("", string)
+
+
 def normalise_string(string: str, *, digits=False) -> str:
-    """Return cleaned string for comparison.
+    """Return cleaned string for comparison. Results are memoised, the same
+    names and streets come back in every filing.
     Param:
         - digits, set True if digits need to remain.
     """
-    string = string.lower()
-    string = unicodedata.normalize("NFKD", string)
-    string = "".join(c for c in string if not unicodedata.combining(c))
-    string = string.replace("ß", "ss")
+    return _normalise(string, digits)
 
-    if digits:
-        string = re.sub(r"[^a-z0-9]", "", string)
-    else:
-        string = re.sub(r"[^a-z]", "", string)
-    return string
+
+def normalise_strings(strings: Iterable[str], *, digits=False) -> list[str]:
+    """Return normalise_string() of every string."""
+    return [_normalise(s, digits) for s in strings]
 
 
 def fuzzy_equal(a: str, b: str, threshold: int = 90) -> bool:
@@ -27,6 +50,21 @@ def fuzzy_equal(a: str, b: str, threshold: int = 90) -> bool:
     return score >= threshold
 
 
+def fuzzy_threshold(string: str) -> int:
+    """Return the fuzz.ratio threshold used to compare string."""
+    return 90 if len(string) > 4 else 80
+
+
+def max_ratio(len_a: int, len_b: int) -> float:
+    """
+    Return the highest fuzz.ratio two strings of these lengths can reach. Used
+    to rule out candidates without comparing them.
+    """
+    if not len_a + len_b:
+        return 100.0
+    return 200 * min(len_a, len_b) / (len_a + len_b)
+
+
 def fuzzy_keys(key: tuple, keys: Iterable) -> tuple:
     """
     Fuzzy match a key with existings keys and return matching key if exists.
@@ -35,7 +73,7 @@ def fuzzy_keys(key: tuple, keys: Iterable) -> tuple:
 
     for k in keys:
         for i in range(length):
-            threshold = 90 if len(key[i]) > 4 else 80
+            threshold = fuzzy_threshold(key[i])
             if not fuzzy_equal(key[i], k[i], threshold):
                 break
         else:
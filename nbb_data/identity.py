@@ -0,0 +1,142 @@
+import uuid
+from itertools import chain
+
+from sqlalchemy import select
+
+from .classes import PersonIndex, CleanedData
+from .functions import normalise_strings
+from .models import (
+    table_natural_persons, table_entities, table_accounting_codes
+)
+
+
+class IdentityCache:
+    """
+    Process-wide cache of the UUIDs of natural persons and entities.
+
+    Warm it once from the database, then resolve() every company before it
+    is written. A person or entity seen before, in the database or in an
+    earlier company, keeps its UUID instead of getting a fresh one that the
+    upsert would write over the existing one.
+
+    Persons are looked up by the conflict key of natural_persons first, the
+    raw (first_name, last_name, street, street_number), so a person in the
+    database always gets its own UUID back. Otherwise they are fuzzy matched
+    on that key normalised with its digits, but only against persons with
+    the same zipcode whose last name starts with the same 'prefix' letters:
+    a typo in a name matches, another house number or town does not, and a
+    lookup stays cheap with millions of known persons. Entities are looked
+    up by entity id and country code, the conflict key of entities.
+
+    It also tracks the account codes known to be in accounting_codes, so a
+    company only sends the codes that are new. Codes become known through
+    remember_codes(), which the writer calls once they are committed.
+    """
+    prefix = 3
+
+    def __init__(self):
+        self.persons: dict[tuple, uuid.UUID] = {}
+        self.person_blocks: dict[tuple, PersonIndex] = {}
+        self.entities: dict[tuple, uuid.UUID] = {}
+        self.codes: set[str] = set()
+
+    def warm(self, conn):
+        """Load all known persons and entities through connection conn."""
+        persons = conn.execute(select(
+            table_natural_persons.c.person_uuid,
+            table_natural_persons.c.first_name,
+            table_natural_persons.c.last_name,
+            table_natural_persons.c.street,
+            table_natural_persons.c.street_number,
+            table_natural_persons.c.zipcode
+            ))
+        for person_uuid, *key, zipcode in persons:
+            key = tuple(key)
+            if key not in self.persons:
+                self.persons[key] = person_uuid
+                fuzzy = self._fuzzy_key(key)
+                self._block(fuzzy, zipcode)[fuzzy] = person_uuid
+
+        entities = conn.execute(select(
+            table_entities.c.entity_uuid,
+            table_entities.c.entity_id,
+            table_entities.c.country_code
+            ))
+        for entity_uuid, entity_id, country_code in entities:
+            self.entities.setdefault((entity_id, country_code), entity_uuid)
+
+        codes = conn.execute(select(table_accounting_codes.c.accountcode_id))
+        self.codes.update(code for code, in codes)
+
+    @staticmethod
+    def _fuzzy_key(key: tuple) -> tuple:
+        return tuple(normalise_strings((v or "" for v in key), digits=True))
+
+    def _block(self, fuzzy: tuple, zipcode) -> PersonIndex:
+        return self.person_blocks.setdefault(
+            (zipcode or "", fuzzy[1][:self.prefix]), PersonIndex())
+
+    def person_uuid(
+        self, key: tuple, zipcode, default: uuid.UUID
+    ) -> uuid.UUID:
+        """Return the UUID of the person with key, the raw conflict key of
+        natural_persons, living in zipcode. Cache default if new."""
+        known = self.persons.get(key)
+        if known is not None:
+            return known
+
+        fuzzy = self._fuzzy_key(key)
+        block = self._block(fuzzy, zipcode)
+        t = block.match(fuzzy)
+        if t[0]:
+            known = block[t[1]]
+        else:
+            known = block[fuzzy] = default
+        self.persons[key] = known
+        return known
+
+    def entity_uuid(self, key: tuple, default: uuid.UUID) -> uuid.UUID:
+        """Return the UUID of the entity with key (entity_id, country_code),
+        cache default if new."""
+        return self.entities.setdefault(key, default)
+
+    def remember_codes(self, codes):
+        """Mark account codes as committed to accounting_codes."""
+        self.codes.update(codes)
+
+    def resolve(self, cleaned: CleanedData):
+        """Swap the UUIDs in cleaned for known ones and cache the new ones.
+        Drop the account codes already in accounting_codes."""
+        cleaned.facts.new_codes -= self.codes
+
+        persons = {}
+        for person in cleaned.persons_dict.values():
+            # map_person starts with the key columns, then zipcode
+            known = self.person_uuid(
+                tuple(person.values[:4]), person.values[4], person.id)
+            if known != person.id:
+                persons[person.id] = known
+                person.id = known
+
+        entities = {}
+        for entity in cleaned.entities_dict.values():
+            # map_entity starts with entity_id, country_code
+            known = self.entity_uuid(tuple(entity.values[:2]), entity.id)
+            if known != entity.id:
+                entities[entity.id] = known
+                entity.id = known
+
+        if not persons and not entities:
+            return
+
+        for row in chain(
+            cleaned.admin_nat_list,
+            cleaned.admin_legal_list,
+            cleaned.mandates_list,
+            cleaned.part_interest_list,
+            cleaned.shareholders_list
+        ):
+            if row.get("person_uuid") in persons:
+                row["person_uuid"] = persons[row["person_uuid"]]
+            if row.get("entity_uuid") in entities:
+                row["entity_uuid"] = entities[row["entity_uuid"]]
@@ -7,26 +7,51 @@
 # Step 4: Write company references in 'temp_references'.
 # Step 5: Fetch all filings in references and write to 'temp_filing'.
 #
+# Steps 2 to 5 run per enterprise in a thread pool of 'workers' threads. The
+# number of requests in flight towards a single host is capped separately by
+# 'max_per_host', so raising 'workers' never floods the NBB API. Set both to 1
+# to fetch sequentially. All calls go through one pooled NBBClient, which
+# retries transient errors and streams filings to disk.
+#
+# Progress is written to the append-only 'fetch_journal.jsonl' as it goes.
+# A rerun skips enterprises and filings recorded as done and retries only the
+# failed ones; delete the journal to fetch everything again.
+#
+# With 'packed' set, references and filings are written to compressed packed
+# stores ('temp_references.pack', 'temp_filing.pack') instead of one json file
+# per document. 'initial_pop.py' must then be run with 'packed' set as well.
+#
 ###############################################################################
 
-import os
 import csv
 import json
-import uuid
+import threading
 import requests
 from datetime import datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from log_config import ScriptLogger
-from nbb_data.classes import URLgen_nbb
+from nbb_data.classes import URLgen_nbb, NBBClient
+from nbb_data.journal import FetchJournal
+from nbb_data.store import open_store
+
 
+workers = 32  # enterprises fetched concurrently
+max_per_host = 16  # requests in flight per host
+packed = False  # write to packed stores instead of json files
 
-ref_logger = ScriptLogger("logs/ref_url.log", level=20)
-data_logger = ScriptLogger("logs/data_url.log", level=20)
+ref_logger = ScriptLogger("logs/ref_url.log", level=20, queued=True)
+data_logger = ScriptLogger("logs/data_url.log", level=20, queued=True)
 
 success = 0
 fail = 0
 failed_ent_list = []
 
+journal = FetchJournal("fetch_journal.jsonl")
+ref_store = open_store("temp_references", packed=packed)
+filing_store = open_store("temp_filing", packed=packed)
+
 # Step 1
 with open("server4.csv", newline="") as csvfile:
     read = csv.reader(csvfile)
@@ -35,33 +60,30 @@ with open("server4.csv", newline="") as csvfile:
 length = len(enterprise_lst)
 
 # Step 2
-api_authentic = os.getenv("API_KEY_AUTHENTIC")
-
-hdr_ref = {
-    "X-Request-Id": str(uuid.uuid4()),
-    "NBB-CBSO-Subscription-Key": api_authentic,
-    "Accept": "application/json",
-    "User-Agent": "PostmanRuntime/7.37.3"
-}
-
-hdr_accData = {
-    "X-Request-Id": str(uuid.uuid4()),
-    "NBB-CBSO-Subscription-Key": api_authentic,
-    "Accept": "application/x.jsonxbrl",
-    "User-Agent": "PostmanRuntime/7.37.3"
-}
-
-for ent in enterprise_lst[:2]:
-    ent = ent.replace(".", "")
+client = NBBClient(pool_size=max_per_host)
+
+host_slots: dict[str, threading.BoundedSemaphore] = {}
+host_lock = threading.Lock()
+
+
+def host_slot(url: str) -> threading.BoundedSemaphore:
+    """Return the semaphore holding the 'max_per_host' slots of url's host."""
+    host = urlsplit(url).netloc
+    with host_lock:
+        return host_slots.setdefault(
+            host, threading.BoundedSemaphore(max_per_host))
+
+
+def fetch_enterprise(ent: str) -> bool:
+    """Run step 2 to 5 for one enterprise. Return False if it failed."""
     url_nbb = URLgen_nbb(db="authentic", request="ref", ref_id=ent).url
 
     try:
-        resp = requests.get(url_nbb, headers=hdr_ref)
+        with host_slot(url_nbb):
+            resp = client.get(url_nbb, "ref")
     except Exception:
         ref_logger.log.error(f"no response for {url_nbb}")
-        fail += 1
-        failed_ent_list.append(ent)
-        continue
+        return False
 
     json_data = resp.json()
     if not isinstance(json_data, list) or not json_data:
@@ -70,9 +92,7 @@ for ent in enterprise_lst[:2]:
             f"Data: {json_data}. "
             f"URL: {url_nbb}"
         ))
-        fail += 1
-        failed_ent_list.append(ent)
-        continue
+        return False
 
     # Step 3
     try:
@@ -88,9 +108,7 @@ for ent in enterprise_lst[:2]:
             )
     except Exception as e:
         ref_logger.log.error(f"No exercise dates found in {ent}: {e}")
-        fail += 1
-        failed_ent_list.append(ent)
-        continue
+        return False
 
     acc_ref_list: list[tuple] = []
     for dct in list_of_ref:
@@ -99,42 +117,71 @@ for ent in enterprise_lst[:2]:
             )
 
     # Step 4
-    target = "temp_references/{}.json"
     try:
-        with open(target.format(ent), "w") as file:
-            json.dump(list_of_ref, file, indent=4)
+        ref_store.put(ent, json.dumps(list_of_ref, indent=4).encode())
     except Exception as e:
         ref_logger.log.error(f"While writing references file. {ent} - {e}")
-        fail += 1
-        failed_ent_list.append(ent)
-        continue
+        return False
 
     # Step 5: Fetch companies filings
-    data_list = []
-    target = "temp_filing/{}.json"
     for ref in acc_ref_list:
-        try:
-            resp = requests.get(ref[0], headers=hdr_accData)
-        except Exception as e:
-            data_logger.log.error(f"For {ent} - {ref[1]}: {e}")
+        if journal.filing_done(ref[1]):
             continue
 
-        if resp.status_code != 200:
-            data_logger.log.warning(
-                f"Status: {resp.status_code} for {ent} - {ref[1]}")
-            continue
-
-        data_list.append(ref[1])
+        status = None
         try:
-            with open(target.format(ref[1]), "wb") as data:
-                data.write(resp.content)
+            with host_slot(ref[0]):
+                status = client.download(ref[0], filing_store, ref[1])
+        except requests.RequestException as e:
+            data_logger.log.error(f"For {ent} - {ref[1]}: {e}")
         except Exception as e:
             data_logger.log.error(
                 f"Likely failed because no JSONXBRL. {ent} - {e}")
+
+        if status != 200:
+            if status is not None:
+                data_logger.log.warning(
+                    f"Status: {status} for {ent} - {ref[1]}")
+            journal.record_filing(ref[1], journal.FAILED, enterprise_id=ent)
             continue
 
-    success += 1
+        journal.record_filing(ref[1], journal.OK, enterprise_id=ent)
+
+    complete = all(journal.filing_done(ref[1]) for ref in acc_ref_list)
+    journal.record_enterprise(ent, journal.OK if complete else journal.FAILED)
+    return True
+
 
+todo = [
+    ent.replace(".", "")
+    for ent in enterprise_lst[:2]
+    if not journal.enterprise_done(ent.replace(".", ""))
+    ]
+skipped = len(enterprise_lst[:2]) - len(todo)
+
+with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = {pool.submit(fetch_enterprise, ent): ent for ent in todo}
+    for future in as_completed(futures):
+        ent = futures[future]
+        try:
+            ok = future.result()
+        except Exception as e:
+            ref_logger.log.error(f"Unexpected error for {ent}: {e}")
+            ok = False
+
+        if ok:
+            success += 1
+        else:
+            fail += 1
+            failed_ent_list.append(ent)
+            journal.record_enterprise(ent, journal.FAILED)
+
+ref_logger.log.info(f"{skipped} of {length} skipped, done in journal.")
 ref_logger.log.info(f"{success} of {length} succesfully fetched.")
 ref_logger.log.info(f"{fail} of {length} failed to fetched.")
 ref_logger.log.info(f"List of fails: {failed_ent_list}.")
+
+client.close()
+journal.close()
+ref_store.close()
+filing_store.close()
@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+
+class FetchJournal:
+    """
+    Append-only journal of the fetch progress, one JSON record per line.
+
+    Every enterprise and filing gets a record as soon as its status is known,
+    so a crashed run can resume where it stopped. On open the file is replayed
+    once into memory; the last record of a key wins. After that every lookup
+    and every append costs the same, whatever the size of the journal. A
+    torn last line from a crash is ignored on replay.
+
+    Statuses:
+    - 'ok': done, skip on restart.
+    - 'failed': retry on restart.
+
+    Besides enterprises and filings, the days handled by the daily delta
+    sync are journaled as 'sync' records keyed by date (%Y-%m-%d).
+
+    Params:
+    - path: journal file, created if missing.
+    - fsync: set True to fsync every record (survives power loss).
+    """
+    OK = "ok"
+    FAILED = "failed"
+
+    def __init__(self, path, *, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.enterprises: dict[str, str] = {}
+        self.filings: dict[str, str] = {}
+        self.syncs: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        torn = False
+        if os.path.exists(path):
+            torn = self._replay()
+        self._file = open(path, "a", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+
+    def _replay(self) -> bool:
+        """Load the journal. Return True if the last line is torn."""
+        kinds = {
+            "enterprise": self.enterprises,
+            "filing": self.filings,
+            "sync": self.syncs
+        }
+        line = "\n"
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    kinds[record["kind"]][record["id"]] = record["status"]
+                except (ValueError, KeyError):
+                    continue
+        return not line.endswith("\n")
+
+    def _append(self, kind, key, status, **extra):
+        record = {
+            "kind": kind,
+            "id": key,
+            "status": status,
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            **extra
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def enterprise_done(self, enterprise_id) -> bool:
+        return self.enterprises.get(enterprise_id) == self.OK
+
+    def filing_done(self, reference_number) -> bool:
+        return self.filings.get(reference_number) == self.OK
+
+    def record_enterprise(self, enterprise_id, status):
+        self.enterprises[enterprise_id] = status
+        self._append("enterprise", enterprise_id, status)
+
+    def record_filing(self, reference_number, status, *, enterprise_id=None):
+        self.filings[reference_number] = status
+        self._append(
+            "filing", reference_number, status, enterprise=enterprise_id)
+
+    def record_sync(self, date, status):
+        self.syncs[date] = status
+        self._append("sync", date, status)
+
+    def last_sync(self) -> str | None:
+        """Return the last date synced successfully, if any."""
+        return max(
+            (k for k, v in self.syncs.items() if v == self.OK), default=None)
+
+    def failed_enterprises(self) -> list[str]:
+        return [k for k, v in self.enterprises.items() if v == self.FAILED]
+
+    def failed_filings(self) -> list[str]:
+        return [k for k, v in self.filings.items() if v == self.FAILED]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,239 @@
+import re
+from datetime import datetime
+from typing import Callable
+
+
+class Param:
+    """A value passed to the mapper, e.g. Param("enterprise_id")."""
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Field:
+    """
+    A value read from the source record.
+
+    Params:
+    - path: keys leading to the value. All but the last must be present
+      (KeyError otherwise), the last one may be missing.
+    - lower, prefix, date, lookup: transforms of the value, applied in that
+      order when the value is truthy. prefix is stripped, date parses
+      'YYYY-MM-DD', lookup maps the value through the mapping passed to the
+      mapper under that name.
+    - convert: function applied to the value, truthy or not.
+    - fallback: Field used when the value is falsy.
+    - default: result when the value (and its fallback) is falsy.
+
+    Without transform, fallback or default the value is kept as is.
+    """
+    def __init__(
+        self,
+        *path: str,
+        lower=False,
+        prefix: str | None = None,
+        date=False,
+        lookup: str | None = None,
+        convert: Callable | None = None,
+        fallback: "Field | None" = None,
+        default=None
+    ):
+        self.path = path
+        self.lower = lower
+        self.prefix = prefix
+        self.date = date
+        self.lookup = lookup
+        self.convert = convert
+        self.fallback = fallback
+        self.default = default
+
+
+_NOT_DIGIT = re.compile(r"[^\d]")
+
+
+def iso_date(value: str) -> datetime:
+    """Parse 'YYYY-MM-DD' like strptime(value, "%Y-%m-%d"), skipping the
+    format parser for well formed dates."""
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        try:
+            return datetime(int(value[:4]), int(value[5:7]), int(value[8:]))
+        except ValueError:
+            pass
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def compile_mapper(
+    name: str, spec: dict, *, as_tuple=False
+) -> Callable[..., dict | tuple]:
+    """
+    Compile spec, a dict of column: Field | Param, into a function returning
+    the row of one source record. The function takes the record, then the
+    Params and lookups by name:
+
+        map_x = compile_mapper("x", {"a": Param("a"), "b": Field("B")})
+        map_x(record, a=1)
+
+    With as_tuple the row is a tuple of the values in the order of spec,
+    whose columns are in map_x.columns.
+
+    The body is generated once, so a row costs no interpretation of the spec:
+    every intermediate dict is read once and every transform is inlined.
+    """
+    env = {"iso_date": iso_date}
+    params: list[str] = []
+    parents: dict[tuple, str] = {(): "src"}
+    body: list[str] = []
+
+    def parent(path: tuple) -> str:
+        if path not in parents:
+            var = f"_p{len(parents)}"
+            body.append(f"    {var} = {parent(path[:-1])}[{path[-1]!r}]")
+            parents[path] = var
+        return parents[path]
+
+    def constant(value) -> str:
+        var = f"_c{len(env)}"
+        env[var] = value
+        return var
+
+    def expression(field: Field) -> str:
+        getter = f"{parent(field.path[:-1])}.get({field.path[-1]!r})"
+        var = f"_v{len(body)}"
+        body.append(f"    {var} = {getter}")
+
+        if field.convert is not None:
+            return f"{constant(field.convert)}({var})"
+
+        value = var
+        if field.lower:
+            value = f"{value}.lower()"
+        if field.prefix:
+            value = f"{value}.removeprefix({field.prefix!r})"
+        if field.date:
+            value = f"iso_date({value})"
+        if field.lookup:
+            if field.lookup not in params:
+                params.append(field.lookup)
+            value = (
+                f"({field.lookup}.get({value}) "
+                f"or {constant(field.default)})")
+
+        if field.fallback is not None:
+            otherwise = expression(field.fallback)
+        elif field.default is not None:
+            otherwise = constant(field.default)
+        elif value == var:
+            return var
+        else:
+            otherwise = "None"
+        return f"({value} if {var} else {otherwise})"
+
+    columns = []
+    for column, source in spec.items():
+        if isinstance(source, Param):
+            if source.name not in params:
+                params.append(source.name)
+            value = source.name
+        else:
+            value = expression(source)
+        columns.append(value if as_tuple else f"{column!r}: {value}")
+
+    signature = ", ".join(["src", *(f"{p}=None" for p in params)])
+    source = "\n".join([
+        f"def map_{name}({signature}):",
+        *body,
+        "    return (" if as_tuple else "    return {",
+        *(f"        {c}," for c in columns),
+        "    )" if as_tuple else "    }",
+    ])
+    exec(compile(source, f"<mapper {name}>", "exec"), env)
+    mapper = env[f"map_{name}"]
+    mapper.source = source
+    mapper.columns = tuple(spec)
+    return mapper
+
+
+def int_float(value) -> int:
+    return int(float(value))
+
+
+def only_digits(value: str) -> str:
+    return _NOT_DIGIT.sub("", value)
+
+
+def _country():
+    return Field(
+        "Address", "Country", prefix="cty:m",
+        fallback=Field(
+            "Address", "OtherCountry", lookup="countries", default="XX")
+        )
+
+
+def _zipcode():
+    return Field(
+        "Address", "City", prefix="pcd:m",
+        fallback=Field("Address", "OtherPostalCode", default="0000")
+        )
+
+
+# Values of the natural_persons table but person_uuid, from a 'Person'
+# record. The key fields come first.
+map_person = compile_mapper("person", {
+    "first_name": Field("FirstName", lower=True),
+    "last_name": Field("LastName", lower=True),
+    "street": Field("Address", "Street", lower=True),
+    "street_number": Field("Address", "Number"),
+    "zipcode": _zipcode(),
+    "country_code": _country(),
+}, as_tuple=True)
+
+# Values of the entities table but entity_uuid, from an 'Entity' record.
+map_entity = compile_mapper("entity", {
+    "entity_id": Field("Identifier", convert=only_digits),
+    "country_code": _country(),
+    "denomination": Field("Name"),
+    "street": Field("Address", "Street", lower=True),
+    "street_number": Field("Address", "Number"),
+    "zipcode": _zipcode(),
+}, as_tuple=True)
+
+# Rows of the mandates table, from a 'Mandates' record.
+map_mandate = compile_mapper("mandate", {
+    "person_uuid": Param("person_uuid"),
+    "enterprise_id": Param("enterprise_id"),
+    "function_code": Field("FunctionMandate", prefix="fct:m"),
+    "start_date": Field("MandateDates", "StartDate", date=True),
+    "end_date": Field("MandateDates", "EndDate", date=True),
+    "account_year": Param("account_year"),
+})
+
+# Rows of the participating_interests table: the columns of a
+# 'ParticipatingInterests' record followed by those of each of its
+# 'ParticipatingInterestHeld' records.
+map_participation = compile_mapper("participation", {
+    "enterprise_id": Param("enterprise_id"),
+    "entity_uuid": Param("entity_uuid"),
+    "account_year": Param("account_year"),
+    "account_date": Field("AccountDate", date=True),
+    "currency": Field("Currency", prefix="ccy:m"),
+    "equity": Field("Equity", convert=int_float),
+    "net_result": Field("NetResult", convert=int_float),
+})
+map_participation_held = compile_mapper("participation_held", {
+    "nature": Field("Nature"),
+    "line": Field("Line"),
+    "amount": Field("Number"),
+    "percentage_held": Field("PercentageDirectlyHeld"),
+    "percentage_subsidiary": Field("PercentageSubsidiaries"),
+})
+
+# Rows of the shareholders table, from a 'RightsHeld' record.
+map_shareholder = compile_mapper("shareholder", {
+    "enterprise_id": Param("enterprise_id"),
+    "entity_uuid": Param("entity_uuid"),
+    "account_year": Param("account_year"),
+    "nature_rights": Field("Nature"),
+    "line_rights": Field("Line"),
+    "securities_attached": Field("NumberSecuritiesAttached"),
+    "not_securities_attached": Field("not_securities_attached"),
+    "percentage": Field("Percentage"),
+})
@@ -0,0 +1,155 @@
+import re
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, roughly logarithmic buckets from 10 us to
+    100 s. Percentiles are estimated as the upper bound of their bucket,
+    capped at the largest value seen.
+    """
+    bounds = tuple(
+        m * 10.0 ** e for e in range(-5, 2) for m in (1, 2, 5)) + (100.0,)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return round(min(self.bounds[i], self.max), 6)
+                return round(self.max, 6)
+        return round(self.max, 6)
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "mean": round(self.total / self.count, 6),
+            "min": round(self.min, 6),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 6),
+            "buckets": {
+                (f"<={self.bounds[i]:g}" if i < len(self.bounds) else "inf"): n
+                for i, n in enumerate(self.buckets)
+                if n
+            }
+        }
+
+
+class Metrics:
+    """
+    Counters and per-stage latency histograms of one run, dumped as JSON at
+    the end.
+
+    Time a stage in-line with 'with metrics.stage("name")' or add durations
+    measured elsewhere, e.g. in a worker process, with observe(). Once
+    instrument() is called on an engine, every SQL statement it executes is
+    timed under 'sql <VERB> <table>', with its row count.
+    """
+    _sql_target = re.compile(
+        r"^\s*(\w+)(?:.*?\b(?:INTO|FROM|UPDATE|TABLE)\s+([\w.\"]+))?",
+        re.IGNORECASE | re.DOTALL
+        )
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: dict[str, int] = {}
+        self.stages: dict[str, Histogram] = {}
+        self.sql: dict[str, Histogram] = {}
+        self.sql_rows: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_all(self, counts: dict[str, int]):
+        """Add counts, e.g. the row counts of population.upsert_counts."""
+        with self._lock:
+            for name, n in counts.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_all(self, timings: dict[str, float]):
+        """Add the stage durations collected by parse_company."""
+        for name, seconds in timings.items():
+            self.observe(name, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def instrument(self, engine):
+        """Time every statement executed by engine."""
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, params, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, params, context, many):
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        match = self._sql_target.match(statement)
+        name = " ".join(filter(None, ("sql", match[1].upper(), match[2])))
+        with self._lock:
+            histogram = self.sql.get(name)
+            if histogram is None:
+                histogram = self.sql[name] = Histogram()
+            histogram.observe(seconds)
+            if cursor.rowcount and cursor.rowcount > 0:
+                self.sql_rows[name] = (
+                    self.sql_rows.get(name, 0) + cursor.rowcount)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "elapsed": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "stages": {
+                    name: h.summary() for name, h in self.stages.items()},
+                "sql": {
+                    name: {**h.summary(), "rows": self.sql_rows.get(name, 0)}
+                    for name, h in self.sql.items()
+                    }
+            }
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=4)
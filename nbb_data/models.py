@@ -1,19 +1,58 @@
+import os
+
+from dotenv import load_dotenv
 from sqlalchemy import (
-    MetaData, Table, Column, String, Integer, Float, Uuid, Date)
+    MetaData, Table, Column, String, Integer, SmallInteger, Float, Uuid, Date,
+    DateTime, UniqueConstraint, Index, Identity, ForeignKey, func,
+    literal_column)
+
+load_dotenv()
+
+# The unique constraints are the conflict targets of the upserts in
+# nbb_data.population.UPSERTS, keep them in line. Keys holding columns that
+# may be NULL treat NULLs as equal (PostgreSQL 15+), otherwise such rows would
+# never conflict. SQLite, for local runs, has no such option: there each of
+# those keys gets a unique index on its columns with NULLs swapped for
+# NULL_KEY, see sqlite_keys.
+#
+# With NBB_FACTS_PARTITIONED set, statement_facts is range partitioned by
+# account_year. Its partitions are created by nbb_data.bootstrap.
+#
+# NBB_FACTS_LAYOUT selects the layout of statement_facts, the largest table:
+# - wide (default): account_year, filing_id and accountcode_id as strings.
+# - compact: an integer account_year, and the integer filing_key and
+#   accountcode_key surrogates of statements and accounting_codes. The
+#   filing_key identifies the statement of a period, a correction replacing
+#   its filing keeps it and the facts of the replaced filing are deleted (see
+#   nbb_data.population.replaced_facts). The loader swaps ids for keys while
+#   inserting.
+facts_partitioned = os.getenv(
+    "NBB_FACTS_PARTITIONED", "").lower() in ("1", "true", "yes")
+facts_layout = os.getenv("NBB_FACTS_LAYOUT", "wide").lower()
+if facts_layout not in ("wide", "compact"):
+    raise ValueError(f"Unknown NBB_FACTS_LAYOUT {facts_layout}")
+compact_facts = facts_layout == "compact"
 
-metadata = MetaData()
+metadata = MetaData(
+    naming_convention={"uq": "uq_%(table_name)s_%(column_0_name)s"})
 
 table_accounting_codes = Table(
     "accounting_codes", metadata,
     Column("accountcode_id", String, primary_key=True),
-    Column("denomination", String)
+    Column("denomination", String),
+    *(
+        [Column("accountcode_key", Integer, Identity(), unique=True)]
+        if compact_facts else []
+    )
     )
 
 table_administrators_natural = Table(
     "administrators_natural", metadata,
     Column("enterprise_id", String),
     Column("person_uuid", String),
-    Column("account_year", Integer)
+    Column("account_year", Integer),
+    UniqueConstraint("enterprise_id", "person_uuid", "account_year"),
+    Index("ix_administrators_natural_person_uuid", "person_uuid")
     )
 
 table_administrators_legal = Table(
@@ -21,7 +60,10 @@ table_administrators_legal = Table(
     Column("enterprise_id", String),
     Column("entity_uuid", Uuid),
     Column("person_uuid", Uuid),
-    Column("account_year", Integer)
+    Column("account_year", Integer),
+    UniqueConstraint(
+        "enterprise_id", "entity_uuid", "person_uuid", "account_year"),
+    Index("ix_administrators_legal_person_uuid", "person_uuid")
     )
 
 table_company_info = Table(
@@ -49,7 +91,8 @@ table_entities = Table(
     Column("denomination", String),
     Column("street", String),
     Column("street_number", String),
-    Column("zipcode", String)
+    Column("zipcode", String),
+    UniqueConstraint("entity_id", "country_code")
     )
 
 table_mandates = Table(
@@ -59,7 +102,11 @@ table_mandates = Table(
     Column("function_code", String),
     Column("start_date", Date),
     Column("end_date", Date),
-    Column("account_year", Integer)
+    Column("account_year", Integer),
+    UniqueConstraint(
+        "person_uuid", "enterprise_id", "function_code", "start_date",
+        "end_date", "account_year", postgresql_nulls_not_distinct=True),
+    Index("ix_mandates_enterprise_id", "enterprise_id")
 )
 
 table_natural_persons = Table(
@@ -70,7 +117,11 @@ table_natural_persons = Table(
     Column("street", String),
     Column("street_number", String),
     Column("zipcode", String),
-    Column("country_code", String)
+    Column("country_code", String),
+    UniqueConstraint(
+        "first_name", "last_name", "street", "street_number",
+        postgresql_nulls_not_distinct=True),
+    Index("ix_natural_persons_person_uuid", "person_uuid")
     )
 
 table_part_int = Table(
@@ -86,7 +137,10 @@ table_part_int = Table(
     Column("line", String),
     Column("amount", String),
     Column("percentage_held", Float),
-    Column("percentage_subsidiary", Float)
+    Column("percentage_subsidiary", Float),
+    UniqueConstraint(
+        "enterprise_id", "entity_uuid", "account_year", "nature", "line",
+        postgresql_nulls_not_distinct=True)
     )
 
 table_shareholders = Table(
@@ -100,16 +154,39 @@ table_shareholders = Table(
     Column("line_rights", String),
     Column("securities_attached", Integer),
     Column("not_securities_attached", String),
-    Column("percentage", Float)
+    Column("percentage", Float),
+    UniqueConstraint(
+        "enterprise_id", "entity_uuid", "person_uuid", "account_year",
+        "nature_rights", "line_rights", postgresql_nulls_not_distinct=True),
+    Index("ix_shareholders_person_uuid", "person_uuid")
     )
 
-table_facts = Table(
-    "statement_facts", metadata,
-    Column("account_year", String),
-    Column("filing_id", String),
-    Column("accountcode_id", String),
-    Column("book_value", Float),
-    )
+if compact_facts:
+    table_facts = Table(
+        "statement_facts", metadata,
+        Column("account_year", SmallInteger),
+        Column(
+            "filing_key", Integer, ForeignKey("statements.filing_key")),
+        Column(
+            "accountcode_key", Integer,
+            ForeignKey("accounting_codes.accountcode_key")),
+        Column("book_value", Float),
+        UniqueConstraint("filing_key", "accountcode_key", "account_year"),
+        postgresql_partition_by=(
+            "RANGE (account_year)" if facts_partitioned else None)
+        )
+else:
+    table_facts = Table(
+        "statement_facts", metadata,
+        Column("account_year", String),
+        Column("filing_id", String),
+        Column("accountcode_id", String),
+        Column("book_value", Float),
+        UniqueConstraint("account_year", "filing_id", "accountcode_id"),
+        Index("ix_statement_facts_filing_id", "filing_id"),
+        postgresql_partition_by=(
+            "RANGE (account_year)" if facts_partitioned else None)
+        )
 
 table_statements = Table(
     "statements", metadata,
@@ -124,4 +201,48 @@ table_statements = Table(
     Column("activity_code", String),
     Column("model_type", String),
     Column("last_update", Date),
+    *(
+        [Column("filing_key", Integer, Identity(), unique=True)]
+        if compact_facts else []
+    ),
+    UniqueConstraint("enterprise_id", "start_date", "end_date"),
+    Index("ix_statements_filing_id", "filing_id")
     )
+
+# Content hash of every reference file and filing applied to the database,
+# so unchanged documents are skipped on the next run. document_kind is
+# 'references' (document_id = enterprise id) or 'filing' (filing id).
+table_load_ledger = Table(
+    "load_ledger", metadata,
+    Column("document_kind", String, primary_key=True),
+    Column("document_id", String, primary_key=True),
+    Column("content_hash", String),
+    Column("applied_at", DateTime)
+    )
+
+# An empty blob, equal to no value stored in a key column
+NULL_KEY = literal_column("X''")
+
+
+def _sqlite_key(constraint) -> list:
+    """
+    Add a unique index, created on SQLite only, on the columns of constraint
+    with NULLs swapped for NULL_KEY. Return its expressions, the conflict
+    target of the upserts there.
+    """
+    index = Index(
+        f"{constraint.name}_sqlite",
+        *(func.coalesce(c, NULL_KEY) for c in constraint.columns),
+        unique=True
+        ).ddl_if(dialect="sqlite")
+    return list(index.expressions)
+
+
+# Conflict target on SQLite of the keys treating NULLs as equal, per table
+sqlite_keys = {
+    table.name: _sqlite_key(constraint)
+    for table in metadata.sorted_tables
+    for constraint in table.constraints
+    if isinstance(constraint, UniqueConstraint)
+    and constraint.dialect_options["postgresql"]["nulls_not_distinct"]
+}
@@ -0,0 +1,718 @@
+import json
+import time
+import hashlib
+import multiprocessing
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import (
+    Column, String, Integer, Float, Date, select, values, cast, or_, and_,
+    delete, literal_column
+)
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import (
+    table_accounting_codes, table_administrators_natural,
+    table_administrators_legal, table_company_info, table_entities,
+    table_facts, table_natural_persons, table_part_int, table_shareholders,
+    table_statements, table_mandates, table_load_ledger, compact_facts,
+    facts_partitioned, sqlite_keys
+)
+from .classes import (
+    References, Filing, LazyFiling, Person, Entity, CleanedData
+)
+from .store import open_store
+from .mappers import (
+    map_mandate, map_participation, map_participation_held, map_shareholder
+)
+
+
+def _lap(timings: dict, stage: str, since: float) -> float:
+    """Add the time since 'since' to stage and return the current time."""
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - since
+    return now
+
+
+def _mandates(cleaned, mandates, person_uuid, enterprise_id, year):
+    """Add the mandates of a person to cleaned.mandates_list."""
+    for mandate in mandates:
+        try:
+            cleaned.mandates_list.append(map_mandate(
+                mandate,
+                person_uuid=person_uuid,
+                enterprise_id=enterprise_id,
+                account_year=year
+                ))
+        except Exception as e:
+            cleaned.errors.append(
+                f"Mandates: {enterprise_id}. Error: {e}")
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_ledger(conn) -> dict[tuple, str]:
+    """Return the load_ledger as {(document_kind, document_id): hash}."""
+    rows = conn.execute(select(
+        table_load_ledger.c.document_kind,
+        table_load_ledger.c.document_id,
+        table_load_ledger.c.content_hash
+        ))
+    return {(kind, id_): hash_ for kind, id_, hash_ in rows}
+
+
+def parse_company(
+    key, ref_store, filing_store, country_codes, *, lazy=False, ledger=None
+) -> CleanedData:
+    """
+    Parse the reference list stored under key and its filings into a
+    CleanedData payload. Nothing is logged here: errors are collected in
+    cleaned.errors for the caller to log, so this runs as well in a worker
+    process. If the reference list fails to load, company_info stays empty.
+    With lazy, filings are parsed by LazyFiling, keeping only 'N' rubrics,
+    which saves memory on large filings, not time.
+
+    The time spent per stage (load, references, persons, rubrics) is added
+    up in cleaned.timings.
+
+    The content hash of the reference file and of every filing parsed goes to
+    cleaned.ledger_list, unless already in the ledger. With ledger, the
+    hashes already loaded (see read_ledger), filings whose hash is in it are
+    skipped. If the reference file is unchanged too, nothing is returned but
+    cleaned.unchanged.
+    """
+    cleaned = CleanedData()
+    timings = cleaned.timings
+    ledger = ledger or {}
+    now = datetime.now()
+
+    try:
+        lap = time.perf_counter()
+        data = ref_store.get(key)
+        lap = _lap(timings, "load", lap)
+        references = References(json.loads(data))
+        _lap(timings, "references", lap)
+
+        digest = content_hash(data)
+        unchanged = ledger.get(("references", key)) == digest
+        if not unchanged:
+            cleaned.ledger_list.append({
+                "document_kind": "references",
+                "document_id": key,
+                "content_hash": digest,
+                "applied_at": now
+            })
+
+        cleaned.company_info = {
+            "enterprise_id": references.enterprise_id,
+            "denomination": references.enterprise_name,
+            "legal_situation": references.legal_situation
+        }
+        cleaned.statements_list = references.filings_list
+    except Exception as e:
+        cleaned.errors.append(
+            f"Failed to load reference list for {key}. Error {e}"
+        )
+        return cleaned
+
+    # Step 2
+    filings_list = [
+        (d.filing_id, d.account_year)
+        for d in references.filings_list
+        ]
+
+    for tupl in filings_list:
+        lap = time.perf_counter()
+        try:
+            data = filing_store.get(tupl[0])
+            if data is None:
+                raise FileNotFoundError(f"No filing {tupl[0]} in store")
+            digest = content_hash(data)
+            if ledger.get(("filing", tupl[0])) == digest:
+                _lap(timings, "load", lap)
+                continue
+            filing = (
+                LazyFiling(data) if lazy else Filing(json.loads(data)))
+        except Exception as e:
+            unchanged = False
+            cleaned.errors.append(f"{e}")
+            continue
+
+        unchanged = False
+        cleaned.ledger_list.append({
+            "document_kind": "filing",
+            "document_id": tupl[0],
+            "content_hash": digest,
+            "applied_at": now
+        })
+
+        lap = _lap(timings, "load", lap)
+        year = tupl[1]
+
+        # 2.a Natural Persons
+        for natural in filing.administrators["NaturalPersons"]:
+            try:
+                temp_person = Person(natural['Person'], country_codes)
+                t = cleaned.persons_dict.match(temp_person.key)
+
+                if t[0]:
+                    old_temp_person = cleaned.persons_dict[t[1]]
+                    temp_person.id = old_temp_person.id
+                    cleaned.persons_dict[t[1]] = temp_person
+                else:
+                    cleaned.persons_dict[temp_person.key] = temp_person
+
+                admin_dct = {
+                    "enterprise_id": references.enterprise_id,
+                    "person_uuid": temp_person.id,
+                    "account_year": year
+                }
+                cleaned.admin_nat_list.append(admin_dct)
+            except Exception as e:
+                cleaned.errors.append((
+                    "Whilst retrieving Natural persons for "
+                    f"{references.enterprise_id}. Error {e}"))
+                continue
+
+            if natural["Mandates"]:
+                _mandates(
+                    cleaned, natural["Mandates"], temp_person.id,
+                    references.enterprise_id, year)
+
+        # 2.b Legal Persons
+        for legal in filing.administrators["LegalPersons"]:
+            try:
+                temp_entity = Entity(legal["Entity"], country_codes)
+
+                if temp_entity.key in cleaned.entities_dict.keys():
+                    old_temp_entity = cleaned.entities_dict[temp_entity.key]
+                    temp_entity.id = old_temp_entity.id
+                    cleaned.entities_dict[temp_entity.key] = temp_entity
+                else:
+                    cleaned.entities_dict[temp_entity.key] = temp_entity
+
+            except Exception as e:
+                cleaned.errors.append((
+                    "Whilst retrieving Legal Persons 'entity' for "
+                    f"{references.enterprise_id}. Error {e}"))
+                continue
+
+            for representative in legal["Representatives"]:
+                try:
+                    temp_person = Person(representative, country_codes)
+                    t = cleaned.persons_dict.match(temp_person.key)
+
+                    if t[0]:
+                        old_temp_person = cleaned.persons_dict[t[1]]
+                        temp_person.id = old_temp_person.id
+                        cleaned.persons_dict[t[1]] = temp_person
+                    else:
+                        cleaned.persons_dict[temp_person.key] = temp_person
+
+                    admin_dct = {
+                        "enterprise_id": references.enterprise_id,
+                        "entity_uuid": temp_entity.id,
+                        "person_uuid": temp_person.id,
+                        "account_year": year
+                    }
+                    cleaned.admin_legal_list.append(admin_dct)
+
+                    if legal["Mandates"]:
+                        _mandates(
+                            cleaned, legal["Mandates"], temp_person.id,
+                            references.enterprise_id, year)
+                except Exception as e:
+                    cleaned.errors.append((
+                        "Whilst retrieving representative for "
+                        f"{references.enterprise_id}. Error {e}"
+                    ))
+
+        # 2.c Participating Interests
+        for partint in filing.participating_interests:
+            try:
+                temp_entity = Entity(partint["Entity"], country_codes)
+
+                if temp_entity.key in cleaned.entities_dict.keys():
+                    old_temp_entity = cleaned.entities_dict[temp_entity.key]
+                    temp_entity.id = old_temp_entity.id
+                    cleaned.entities_dict[temp_entity.key] = temp_entity
+                else:
+                    cleaned.entities_dict[temp_entity.key] = temp_entity
+
+            except Exception as e:
+                cleaned.errors.append((
+                    "Partint / Entity for "
+                    f"{references.enterprise_id}. Error: {e}"
+                    ))
+                continue
+
+            try:
+                base_dct = map_participation(
+                    partint,
+                    enterprise_id=references.enterprise_id,
+                    entity_uuid=temp_entity.id,
+                    account_year=year
+                    )
+                for p in partint["ParticipatingInterestHeld"]:
+                    cleaned.part_interest_list.append(
+                        base_dct | map_participation_held(p))
+
+            except Exception as e:
+                cleaned.errors.append(
+                    f"PartIntHeld for {references.enterprise_id}. Error: {e}")
+                continue
+
+        # 2.d Shareholders
+        if filing.shareholders.get("EntityShareHolders"):
+            for entity in filing.shareholders["EntityShareHolders"]:
+                try:
+                    temp_entity = Entity(entity["Entity"], country_codes)
+
+                    if temp_entity.key in cleaned.entities_dict.keys():
+                        old_temp_entity = cleaned.entities_dict[
+                            temp_entity.key]
+                        temp_entity.id = old_temp_entity.id
+                        cleaned.entities_dict[temp_entity.key] = temp_entity
+                    else:
+                        cleaned.entities_dict[temp_entity.key] = temp_entity
+                except Exception as e:
+                    cleaned.errors.append((
+                        "Shareholders / Entity for "
+                        f"{references.enterprise_id}. Error: {e}"
+                        ))
+                    continue
+
+                try:
+                    for s in entity["RightsHeld"]:
+                        cleaned.shareholders_list.append(map_shareholder(
+                            s,
+                            enterprise_id=references.enterprise_id,
+                            entity_uuid=temp_entity.id,
+                            account_year=year
+                            ))
+
+                except Exception as e:
+                    cleaned.errors.append((
+                        f"PartIntHeld for {references.enterprise_id}. "
+                        f"Error: {e}"
+                        ))
+                    continue
+
+        # 2.e Rubrics
+        lap = _lap(timings, "persons", lap)
+        cleaned.facts.start_filing(filing.reference_number, year)
+        try:
+            for r in filing.iter_rubrics(("N",)):
+                cleaned.facts.add(str(r.get("Code")), r.get("Value"))
+        except Exception as e:
+            cleaned.errors.append((
+                f"Rubrics {references.enterprise_id}, filing id "
+                f"{filing.reference_number}. Error {e}"
+            ))
+        _lap(timings, "rubrics", lap)
+
+    if unchanged:
+        unchanged_cleaned = CleanedData()
+        unchanged_cleaned.unchanged = True
+        unchanged_cleaned.timings = timings
+        return unchanged_cleaned
+    return cleaned
+
+
+# Upsert of every table, in the order they must run: (table, conflict columns,
+# columns updated on conflict). Without update columns conflicting rows are
+# skipped (ON CONFLICT DO NOTHING). The UUIDs of persons and entities are
+# never updated: a stored row keeps its UUID, which other rows refer to.
+UPSERTS = [
+    (
+        table_company_info,
+        ["enterprise_id"],
+        ["denomination", "legal_situation"]
+    ),
+    (
+        table_statements,
+        ["enterprise_id", "start_date", "end_date"],
+        [
+            "filing_id", "account_year", "deposit_date", "deposit_type",
+            "legal_form", "activity_code", "model_type", "last_update"
+        ]
+    ),
+    (
+        table_natural_persons,
+        ["first_name", "last_name", "street", "street_number"],
+        ["zipcode", "country_code"]
+    ),
+    (
+        table_entities,
+        ["entity_id", "country_code"],
+        ["denomination", "street", "street_number", "zipcode"]
+    ),
+    (table_administrators_natural, None, None),
+    (table_administrators_legal, None, None),
+    (table_mandates, None, None),
+    (
+        table_part_int,
+        ["enterprise_id", "entity_uuid", "account_year", "nature", "line"],
+        [
+            "account_date", "currency", "equity", "net_result", "amount",
+            "percentage_held", "percentage_subsidiary"
+        ]
+    ),
+    (
+        table_shareholders,
+        [
+            "enterprise_id", "entity_uuid", "person_uuid", "account_year",
+            "nature_rights", "line_rights"
+        ],
+        ["securities_attached", "not_securities_attached", "percentage"]
+    ),
+    (table_accounting_codes, None, None),
+    (
+        table_facts,
+        (
+            ["filing_key", "accountcode_key", "account_year"]
+            if compact_facts
+            else ["account_year", "filing_id", "accountcode_id"]
+        ),
+        ["book_value"]
+    ),
+    (
+        table_load_ledger,
+        ["document_kind", "document_id"],
+        ["content_hash", "applied_at"]
+    ),
+]
+
+# Fact rows always carry filing_id and accountcode_id. In the compact layout
+# they are swapped for their keys by compact_facts_select() while inserting.
+FACT_ROW_KEYS = ["account_year", "filing_id", "accountcode_id"]
+
+
+def fact_row_columns() -> list[Column]:
+    """Return new columns matching the rows of FactBuffer.rows()."""
+    return [
+        Column("account_year", Integer),
+        Column("filing_id", String),
+        Column("accountcode_id", String),
+        Column("book_value", Float)
+        ]
+
+
+def compact_facts_select(source):
+    """
+    Return a select of the fact rows in source (columns as in
+    fact_row_columns) as rows of the compact statement_facts. A fact whose
+    statement or account code is not in the database is left out.
+    """
+    return (
+        select(
+            cast(source.c.account_year, table_facts.c.account_year.type),
+            table_statements.c.filing_key,
+            table_accounting_codes.c.accountcode_key,
+            cast(source.c.book_value, Float)
+            )
+        .join_from(
+            source, table_statements,
+            table_statements.c.filing_id == source.c.filing_id)
+        .join(
+            table_accounting_codes,
+            table_accounting_codes.c.accountcode_id
+            == source.c.accountcode_id)
+        )
+
+
+def replaced_facts(source):
+    """
+    Return, as a CTE, the delete of the compact facts of every statement
+    that source (rows of statements) gives another filing. The statements
+    upsert keeps the filing_key of a corrected statement, the facts of the
+    filing it replaces would otherwise stay beside those of the correction.
+    Added to the statements upsert, so it runs before the update.
+    """
+    replaced = (
+        select(table_statements.c.filing_key)
+        .join_from(
+            table_statements, source,
+            and_(
+                table_statements.c.enterprise_id == source.c.enterprise_id,
+                table_statements.c.start_date
+                == cast(source.c.start_date, Date),
+                table_statements.c.end_date == cast(source.c.end_date, Date)
+                ))
+        .where(
+            table_statements.c.filing_id.is_distinct_from(
+                source.c.filing_id))
+        )
+    return (
+        delete(table_facts)
+        .where(table_facts.c.filing_key.in_(replaced))
+        .cte("replaced_facts")
+        )
+
+
+def company_rows(cleaned: CleanedData) -> dict[str, list[dict]]:
+    """Return the rows of cleaned per table name."""
+    return {
+        table_company_info.name:
+            [cleaned.company_info] if cleaned.company_info else [],
+        table_statements.name: [
+            r._asdict() for r in cleaned.statements_list],
+        table_natural_persons.name: [
+            v.description for v in cleaned.persons_dict.values()],
+        table_entities.name: [
+            v.description for v in cleaned.entities_dict.values()],
+        # A string column there, not every driver adapts UUIDs to strings
+        table_administrators_natural.name: [
+            r | {"person_uuid": str(r["person_uuid"])}
+            for r in cleaned.admin_nat_list
+            ],
+        table_administrators_legal.name: cleaned.admin_legal_list,
+        table_mandates.name: cleaned.mandates_list,
+        table_part_int.name: cleaned.part_interest_list,
+        table_shareholders.name: cleaned.shareholders_list,
+        table_accounting_codes.name: cleaned.facts.code_rows(),
+        table_facts.name: cleaned.facts.rows(),
+        table_load_ledger.name: cleaned.ledger_list,
+    }
+
+
+# Inserts with ON CONFLICT per dialect name, see dialect_insert
+INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+# Parameters bound per statement at most, larger upserts are split
+MAX_PARAMETERS = {
+    "sqlite": 32766,
+}
+
+
+def dialect_insert(table, dialect: str = "postgresql"):
+    """Return the insert into table of dialect, supporting ON CONFLICT."""
+    if dialect not in INSERTS:
+        raise ValueError(
+            f"No upserts for dialect {dialect}, expected one of "
+            f"{list(INSERTS)}")
+    return INSERTS[dialect](table)
+
+
+# Update columns stamped with the time of the load. They change on every
+# parse, so they are left out of the comparison in on_conflict and only
+# written along with a changed row.
+STAMP_COLUMNS = {"last_update", "applied_at"}
+
+
+def on_conflict(stmt, keys, update):
+    """
+    Add the ON CONFLICT clause of the UPSERTS rules to insert stmt. A
+    conflicting row is only updated when one of the update columns but the
+    STAMP_COLUMNS differs, so reloading identical data writes no new row
+    versions. On SQLite keys treating NULLs as equal conflict on their index
+    in models.sqlite_keys. The statement returns 'inserted' for every row
+    inserted or updated, see upsert_counts, except into a partitioned table,
+    whose system columns cannot be returned, and on SQLite, which has no
+    xmax.
+    """
+    if not update:
+        stmt = stmt.on_conflict_do_nothing()
+    else:
+        if isinstance(stmt, sqlite.Insert):
+            keys = sqlite_keys.get(stmt.table.name, keys)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_={col: stmt.excluded[col] for col in update},
+            where=or_(*(
+                stmt.table.c[col].is_distinct_from(stmt.excluded[col])
+                for col in update
+                if col not in STAMP_COLUMNS
+                ))
+        )
+    if not isinstance(stmt, postgresql.Insert) or (
+        stmt.table is table_facts and facts_partitioned
+    ):
+        return stmt
+    return stmt.returning(literal_column("(xmax = 0)").label("inserted"))
+
+
+def upsert_counts(table, result, submitted: int) -> dict[str, int]:
+    """
+    Return the rows of table inserted, updated and left unchanged by the
+    executed upsert result of submitted rows, as {'<table>.inserted': n, ..}.
+    Conflicting rows skipped or equal to the stored row are unchanged. An
+    upsert not returning rows only tells the rows written, under 'written'.
+    """
+    if not result.returns_rows:
+        written = max(result.rowcount, 0)
+        return {
+            f"{table.name}.written": written,
+            f"{table.name}.unchanged": max(submitted - written, 0),
+        }
+
+    inserted = updated = 0
+    for row in result:
+        if row.inserted:
+            inserted += 1
+        else:
+            updated += 1
+    return {
+        f"{table.name}.inserted": inserted,
+        f"{table.name}.updated": updated,
+        f"{table.name}.unchanged": max(submitted - inserted - updated, 0),
+    }
+
+
+def upsert(table, rows, keys, update, dialect="postgresql"):
+    """
+    Return the insert of rows into table, following the UPSERTS rules. Rows
+    sharing a conflict key are collapsed to the last one, an upsert may not
+    update the same row twice. The number of rows left is kept in the
+    'submitted' execution option, for upsert_counts.
+    """
+    compact = compact_facts and table is table_facts
+    if update:
+        row_keys = FACT_ROW_KEYS if compact else keys
+        rows = list(
+            {tuple(r.get(k) for k in row_keys): r for r in rows}.values())
+
+    if compact:
+        # book_value as text, so VALUES never mixes text and numbers
+        source = values(*fact_row_columns(), name="facts").data([
+            (
+                r["account_year"], r["filing_id"], r["accountcode_id"],
+                None if r["book_value"] is None else str(r["book_value"])
+            )
+            for r in rows
+            ])
+        stmt = dialect_insert(table, dialect).from_select(
+            ["account_year", "filing_key", "accountcode_key", "book_value"],
+            compact_facts_select(source)
+            )
+    else:
+        stmt = dialect_insert(table, dialect).values(rows)
+    if compact_facts and table is table_statements:
+        stmt = stmt.add_cte(replaced_facts(
+            values(
+                Column("enterprise_id", String),
+                Column("start_date", Date),
+                Column("end_date", Date),
+                Column("filing_id", String),
+                name="filings"
+                ).data([
+                    (
+                        r["enterprise_id"], r["start_date"], r["end_date"],
+                        r["filing_id"]
+                    )
+                    for r in rows
+                    ])
+            ))
+    return on_conflict(stmt, keys, update).execution_options(
+        submitted=len(rows))
+
+
+def build_statements(cleaned: CleanedData, dialect="postgresql") -> list:
+    """
+    Return the upserts writing cleaned, in the order they must run, for the
+    database dialect named dialect ('postgresql' or 'sqlite'). Rows beyond
+    the MAX_PARAMETERS of the dialect are upserted in several statements.
+    """
+    rows = company_rows(cleaned)
+    statements = []
+    for table, keys, update in UPSERTS:
+        table_rows = rows[table.name]
+        if not table_rows:
+            continue
+        size = MAX_PARAMETERS.get(dialect, 0) // len(table_rows[0])
+        if not size or len(table_rows) <= size:
+            statements.append(upsert(table, table_rows, keys, update, dialect))
+            continue
+        for i in range(0, len(table_rows), size):
+            statements.append(upsert(
+                table, table_rows[i:i + size], keys, update, dialect))
+    return statements
+
+
+_worker: dict = {}
+
+
+def _init_worker(
+    ref_folder, filing_folder, packed, country_codes, lazy, ledger
+):
+    _worker["ref_store"] = open_store(ref_folder, packed=packed)
+    _worker["filing_store"] = open_store(filing_folder, packed=packed)
+    _worker["country_codes"] = country_codes
+    _worker["lazy"] = lazy
+    _worker["ledger"] = ledger
+
+
+def _parse_in_worker(key) -> CleanedData:
+    return parse_company(
+        key,
+        _worker["ref_store"],
+        _worker["filing_store"],
+        _worker["country_codes"],
+        lazy=_worker["lazy"],
+        ledger=_worker["ledger"]
+        )
+
+
+def _result(key, future) -> CleanedData:
+    try:
+        return future.result()
+    except Exception as e:
+        cleaned = CleanedData()
+        cleaned.errors.append(f"Worker failed to parse {key}. Error {e}")
+        return cleaned
+
+
+def parse_companies(
+    keys,
+    ref_folder,
+    filing_folder,
+    country_codes,
+    *,
+    packed=False,
+    lazy=False,
+    ledger=None,
+    workers=1,
+    backlog=4
+):
+    """
+    Yield the parsed CleanedData of every key, in the order of keys.
+
+    With workers > 1 the parsing runs in a pool of forked worker processes,
+    each opening the stores itself. At most workers * backlog companies are
+    parsed ahead of the consumer, so a slow writer does not pile up payloads
+    in memory. The pool forks because the calling script is not import-safe.
+    ledger is passed on to parse_company.
+    """
+    if workers <= 1:
+        ref_store = open_store(ref_folder, packed=packed)
+        filing_store = open_store(filing_folder, packed=packed)
+        try:
+            for key in keys:
+                yield parse_company(
+                    key, ref_store, filing_store, country_codes,
+                    lazy=lazy, ledger=ledger)
+        finally:
+            ref_store.close()
+            filing_store.close()
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(
+            ref_folder, filing_folder, packed, country_codes, lazy, ledger)
+    ) as pool:
+        pending: deque = deque()
+        for key in keys:
+            pending.append((key, pool.submit(_parse_in_worker, key)))
+            if len(pending) >= workers * backlog:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
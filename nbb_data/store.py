@@ -0,0 +1,208 @@
+import os
+import zlib
+import sqlite3
+import argparse
+import threading
+from typing import Iterable, Iterator
+
+
+class FileStore:
+    """
+    Store every document as '{folder}/{key}.json', the historical layout of
+    'temp_references' and 'temp_filing'.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def __contains__(self, key) -> bool:
+        return os.path.exists(self._path(key))
+
+    def keys(self) -> Iterator[str]:
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    yield entry.name[:-5]
+
+    def get(self, key) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data: bytes):
+        self.put_stream(key, (data,))
+
+    def put_stream(self, key, chunks: Iterable[bytes]):
+        """Write chunks to a '.part' file that replaces the document once
+        complete, so a document is never left half written."""
+        target = self._path(key)
+        part = f"{target}.part"
+        try:
+            with open(part, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(part, target)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+    def close(self):
+        pass
+
+
+class PackedStore:
+    """
+    Store documents zlib-compressed in append-only segment files, with an
+    SQLite index mapping each key to (segment, offset, length).
+
+    Every document is compressed on its own, so a read is one index lookup
+    and one positioned read. A segment is closed once it grows past
+    segment_size and a new one is started. A document is only visible after
+    both its bytes and its index row are written; a crash in between leaves
+    some dead bytes at the end of a segment, nothing else. Writing a key
+    again replaces it, the old bytes are not reclaimed.
+
+    Safe to share between threads. Several processes may read the same store,
+    but only one process may write to it.
+
+    Params:
+    - folder: folder holding 'index.sqlite' and the '*.seg' files.
+    - segment_size: size in bytes after which a new segment is started.
+    - level: zlib compression level.
+    """
+    def __init__(self, folder, *, segment_size=1 << 28, level=6):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.level = level
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._readers: dict[int, int] = {}
+        self._index = sqlite3.connect(
+            os.path.join(folder, "index.sqlite"),
+            check_same_thread=False,
+            isolation_level=None
+            )
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("PRAGMA synchronous=NORMAL")
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "key TEXT PRIMARY KEY, segment INTEGER, "
+            "offset INTEGER, length INTEGER)"
+            )
+
+        segments = [
+            int(name[:-4]) for name in os.listdir(folder)
+            if name.endswith(".seg")
+            ]
+        self._segment = max(segments, default=0)
+        self._writer = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.folder, f"{segment:05d}.seg")
+
+    def __contains__(self, key) -> bool:
+        return self._lookup(key) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._index.execute(
+                "SELECT count(*) FROM documents").fetchone()[0]
+
+    def keys(self) -> Iterator[str]:
+        with self._lock:
+            rows = self._index.execute(
+                "SELECT key FROM documents ORDER BY segment, offset"
+                ).fetchall()
+        return (row[0] for row in rows)
+
+    def _lookup(self, key):
+        with self._lock:
+            return self._index.execute(
+                "SELECT segment, offset, length FROM documents WHERE key = ?",
+                (key,)
+                ).fetchone()
+
+    def get(self, key) -> bytes | None:
+        location = self._lookup(key)
+        if location is None:
+            return None
+
+        segment, offset, length = location
+        with self._lock:
+            fd = self._readers.get(segment)
+            if fd is None:
+                fd = os.open(self._segment_path(segment), os.O_RDONLY)
+                self._readers[segment] = fd
+        return zlib.decompress(os.pread(fd, length, offset))
+
+    def put(self, key, data: bytes):
+        self._append(key, zlib.compress(data, self.level))
+
+    def put_stream(self, key, chunks: Iterable[bytes]):
+        """Compress chunks as they arrive. Only the compressed document is
+        held in memory and the write lock is taken once it is complete."""
+        compressor = zlib.compressobj(self.level)
+        parts = [compressor.compress(chunk) for chunk in chunks]
+        parts.append(compressor.flush())
+        self._append(key, b"".join(parts))
+
+    def _append(self, key, blob: bytes):
+        with self._lock:
+            if self._writer is None:
+                self._writer = open(
+                    self._segment_path(self._segment), "ab")
+            if self._writer.tell() > self.segment_size:
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(
+                    self._segment_path(self._segment), "ab")
+
+            offset = self._writer.tell()
+            self._writer.write(blob)
+            self._writer.flush()
+            self._index.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                (key, self._segment, offset, len(blob))
+                )
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+            self._index.close()
+
+
+def open_store(folder, *, packed=False) -> FileStore | PackedStore:
+    """Return the store for folder. Packed stores live in '{folder}.pack'."""
+    if packed:
+        return PackedStore(f"{folder}.pack")
+    return FileStore(folder)
+
+
+if __name__ == "__main__":
+    # Pack an existing folder of json files:
+    # python -m nbb_data.store server1/temp_filing
+    parser = argparse.ArgumentParser(
+        description="Copy a folder of json documents into a packed store.")
+    parser.add_argument("folder")
+    args = parser.parse_args()
+
+    source = FileStore(args.folder)
+    target = open_store(args.folder, packed=True)
+    count = 0
+    for key in source.keys():
+        if key not in target:
+            target.put(key, source.get(key))
+            count += 1
+    target.close()
+    print(f"Packed {count} documents into {args.folder}.pack")